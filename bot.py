@@ -3,12 +3,38 @@ from telebot import types
 import qrcode
 import time
 import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+import multiprocessing
+import bisect
 from datetime import datetime, timedelta
 import logging
-from io import BytesIO
+import logging.handlers
+import atexit
+from io import BytesIO, StringIO
 import json
+import csv
+import contextvars
+import re
+import hashlib
+import hmac
+import math
+import html
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from queue import Queue, Full
 import os
 import sys
+import weakref
+import gc
+import tracemalloc
+from urllib.parse import quote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import requests
+import urllib3
+from urllib3.connection import HTTPConnection
 
 # File ke starting mein ye code add karein (line 22 ke baad)
 print("=" * 60)
@@ -26,7 +52,6 @@ if BOT_TOKEN:
     print(f"Token length: {len(BOT_TOKEN)}")
     
     # Test token immediately
-    import requests
     try:
         test_url = f"https://api.telegram.org/bot{BOT_TOKEN}/getMe"
         print(f"Testing URL: {test_url[:50]}...")
@@ -48,11 +73,118 @@ else:
 
 print("=" * 60)
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# ========== QR RENDER POOL ==========
+# Payment QRs are encoded in worker processes (PIL holds the GIL). The workers
+# are forked here, before this process starts its first thread: a child forked
+# from a multithreaded parent can inherit a lock (logging, requests) that some
+# other thread was holding, and hang on it forever.
+QR_RENDER_PROCESSES = int(os.environ.get("QR_RENDER_PROCESSES", "2"))
+
+def render_qr_png(upi_url):
+    """PNG bytes of a QR code (module level so the process pool can run it)"""
+    qr = qrcode.QRCode(version=1, box_size=10, border=4)
+    qr.add_data(upi_url)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    img_bytes = BytesIO()
+    img.save(img_bytes, format='PNG')
+    return img_bytes.getvalue()
+
+def start_qr_render_pool():
+    """Fork the render workers now; None (render inline) if threads already run"""
+    if QR_RENDER_PROCESSES <= 0 or threading.active_count() > 1:
+        return None
+    try:
+        pool = ProcessPoolExecutor(QR_RENDER_PROCESSES, mp_context=multiprocessing.get_context("fork"))
+        pool.submit(int).result(timeout=10)  # fork context launches every worker on first submit
+        return pool
+    except Exception as e:
+        print(f"⚠️ QR render pool unavailable, rendering inline: {e}")
+        return None
+
+qr_render_pool = start_qr_render_pool()
+
+# ========== STRUCTURED LOGGING ==========
+# One JSON object per line. Handlers only enqueue the record; a QueueListener
+# thread does the formatting and the write so a slow stderr never stalls them.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "TeleBot=ERROR,urllib3=WARNING")  # logger=LEVEL,...
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json | text
+LOG_SAMPLING = os.environ.get("LOG_SAMPLING", "spam_check=100,auto_save=10")  # event=keep 1 in N
+
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+def parse_pairs(spec):
+    """"a=1,b=2" -> {"a": "1", "b": "2"}"""
+    pairs = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = item.partition('=')
+        pairs[name.strip()] = value.strip()
+    return pairs
+
+class JsonFormatter(logging.Formatter):
+    """ts, level, logger, msg plus any extra={} fields (QueueHandler already folded tracebacks into msg)"""
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keep 1 in N records per extra={"event": ...}; warnings and above always pass"""
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        if not rate or rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            seen = self.seen.get(record.event, 0) + 1
+            self.seen[record.event] = seen
+        if (seen - 1) % rate:
+            return False
+        record.sampled = f"1/{rate}"
+        return True
+
+def setup_logging():
+    """Route every logger through one queue to a JSON (or text) stderr writer"""
+    output = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "text":
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    else:
+        output.setFormatter(JsonFormatter())
+    records = Queue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(SamplingFilter({event: int(rate) for event, rate in parse_pairs(LOG_SAMPLING).items()}))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    # telebot attaches its own synchronous stderr handler; let it propagate to ours instead
+    telebot.logger.handlers.clear()
+    for name, level in parse_pairs(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+data_log = logging.getLogger("bot.data")
+spam_log = logging.getLogger("bot.spam")
+broadcast_log = logging.getLogger("bot.broadcast")
+admin_log = logging.getLogger("bot.admin")
 
 # ============ CONFIG FROM ENVIRONMENT ============
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
@@ -64,6 +196,31 @@ UPI_ID = os.environ.get("UPI_ID", "")
 UPI_NAME = os.environ.get("UPI_NAME", "Membership")
 AMOUNT = os.environ.get("AMOUNT", "99")
 
+def parse_price_tiers(spec):
+    """PRICE_TIERS like "basic:Basic:99,pro:Pro Pack:199" -> {key: (label, amount)}"""
+    tiers = OrderedDict()
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        fields = item.split(':')
+        key, amount = fields[0].strip().lower(), fields[-1].strip()
+        label = fields[1].strip() if len(fields) > 2 else key.title()
+        tiers[key] = (label, amount)
+    tiers = tiers or OrderedDict(premium=("Premium", AMOUNT))
+    # Payment webhooks compare against these; a bad one must fail at startup, not per payment
+    for key, (_, amount) in tiers.items():
+        try:
+            valid = math.isfinite(float(amount)) and float(amount) > 0
+        except ValueError:
+            valid = False
+        if not valid:
+            raise ValueError(f"PRICE_TIERS/AMOUNT: tier '{key}' has invalid amount '{amount}'")
+    return tiers
+
+PRICE_TIERS = parse_price_tiers(os.environ.get("PRICE_TIERS", ""))
+PAYMENT_REF_SECRET = os.environ.get("PAYMENT_REF_SECRET", "") or BOT_TOKEN  # keys the HMAC behind payment refs
+
+# QR rendering: LRU of rendered codes, misses encoded on the QR RENDER POOL
+QR_CACHE_SIZE = int(os.environ.get("QR_CACHE_SIZE", "256"))
+
 # Spam protection settings
 MAX_SPAM_COUNT = int(os.environ.get("MAX_SPAM_COUNT", "5"))
 SPAM_TIME_WINDOW = int(os.environ.get("SPAM_TIME_WINDOW", "10"))
@@ -71,7 +228,7 @@ WARNING_MESSAGES = ["⚠️ Please don't spam!", "⚠️ This is your last warni
 BLOCK_DURATIONS = [300, 900, 1800]  # 5min, 15min, 30min (seconds)
 
 # ============ DATA DIRECTORY SETUP ============
-DATA_DIR = "/data"
+DATA_DIR = os.environ.get("DATA_DIR", "/data")
 
 # Create data directory if it doesn't exist
 if not os.path.exists(DATA_DIR):
@@ -83,9 +240,652 @@ START_MESSAGE_FILE = os.path.join(DATA_DIR, "start_message.json")
 USERS_DATA_FILE = os.path.join(DATA_DIR, "users_data.json")
 SPAM_DATA_FILE = os.path.join(DATA_DIR, "spam_data.json")
 BROADCAST_QUEUE_FILE = os.path.join(DATA_DIR, "broadcast_queue.json")
+QR_CACHE_FILE = os.path.join(DATA_DIR, "qr_cache.json")
+LOG_QUEUE_FILE = os.path.join(DATA_DIR, "log_queue.json")
+
+# ============ HTTP TRANSPORT ============
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "4"))
+# Polling workers plus headroom for background flows (broadcasts, payments)
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", str(BOT_WORKERS + 12)))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "25"))
+
+def api_method_from_url(url):
+    """Bot API method name from a request URL (never the token part)"""
+    return str(url).rsplit('/', 1)[-1].split('?', 1)[0]
+
+class TransportStats:
+    """Connection reuse, handshake and per-method latency counters"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections_opened = 0
+        self.requests = 0
+        self.methods = {}  # method -> [calls, errors, total_seconds, max_seconds]
+        self.statuses = {}  # (method, HTTP status or 0 for no response) -> calls
+
+    def record_connection(self):
+        with self.lock:
+            self.connections_opened += 1
+
+    def record_request(self, method, seconds, status):
+        ok = status == 200
+        with self.lock:
+            self.requests += 1
+            self.statuses[(method, status)] = self.statuses.get((method, status), 0) + 1
+            entry = self.methods.get(method)
+            if entry is None:
+                entry = self.methods[method] = [0, 0, 0.0, 0.0]
+            entry[0] += 1
+            if not ok:
+                entry[1] += 1
+            entry[2] += seconds
+            if seconds > entry[3]:
+                entry[3] = seconds
+
+    def summary(self):
+        with self.lock:
+            reused = max(0, self.requests - self.connections_opened)
+            lines = [
+                f"🔌 Requests: {self.requests}",
+                f"🤝 Handshakes (new connections): {self.connections_opened}",
+                f"♻️ Reused connections: {reused} ({reused * 100 // max(1, self.requests)}%)",
+                "",
+                "<b>Per method (calls / errors / avg / max):</b>",
+            ]
+            for method, (calls, errors, total, worst) in sorted(self.methods.items(), key=lambda item: -item[1][0]):
+                lines.append(f"• {method}: {calls} / {errors} / {total / calls * 1000:.0f}ms / {worst * 1000:.0f}ms")
+        return "\n".join(lines)
+
+transport_stats = TransportStats()
+
+class CountingHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    def _new_conn(self):
+        transport_stats.record_connection()
+        return super()._new_conn()
+
+class CountingHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    def _new_conn(self):
+        transport_stats.record_connection()
+        return super()._new_conn()
+
+class PooledTransportAdapter(requests.adapters.HTTPAdapter):
+    """Keep-alive pool sized to the worker count, with per-method timing"""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        status = 0
+        try:
+            response = super().send(request, **kwargs)
+            status = response.status_code
+            response_bytes.set(len(response.content))
+            return response
+        finally:
+            transport_stats.record_request(api_method_from_url(request.path_url), time.perf_counter() - started, status)
+
+def setup_http_transport():
+    """One shared requests session for every sync Bot API call"""
+    session = requests.Session()
+    adapter = PooledTransportAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    
+    telebot.apihelper.session = session
+    telebot.apihelper.SESSION_TIME_TO_LIVE = None  # keep connections alive, no periodic reset
+    telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+    telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+setup_http_transport()
+
+# ============ API TRACING ============
+# Every Bot API call made through apihelper (sync bot) or asyncio_helper
+# (async bot) lands in a bounded buffer: method, chat, latency, size, error.
+API_TRACE_SIZE = int(os.environ.get("API_TRACE_SIZE", "5000"))
+API_SLOW_SECONDS = float(os.environ.get("API_SLOW_SECONDS", "1.0"))
+API_TRACE_UNTIMED = {"getUpdates"}  # long polls: counted, never "slow"
+response_bytes = contextvars.ContextVar("response_bytes", default=0)  # set by the transports
+
+class ApiTracer:
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.calls = deque(maxlen=size)  # (time, method, chat_id, seconds, bytes, error class)
+        self.slow = deque(maxlen=200)
+
+    def record(self, method, chat_id, seconds, size, error):
+        entry = (time.time(), method, chat_id, seconds, size, error)
+        with self.lock:
+            self.calls.append(entry)
+            if seconds >= API_SLOW_SECONDS and method not in API_TRACE_UNTIMED:
+                self.slow.append(entry)
+
+    def summary(self):
+        with self.lock:
+            calls = list(self.calls)
+        if not calls:
+            return "No Bot API calls traced yet"
+        per_method = {}
+        for _, method, _, seconds, size, error in calls:
+            entry = per_method.setdefault(method, [0, 0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += 1 if error else 0
+            entry[2] += seconds
+            entry[3] += size
+        span = max(1.0, time.time() - calls[0][0])
+        lines = [f"<b>Last {len(calls)} calls over {format_duration(span)}</b> (share / calls / errors / avg / bytes):"]
+        for method, (count, errors, total, size) in sorted(per_method.items(), key=lambda item: -item[1][0]):
+            lines.append(
+                f"• {method}: {count * 100 / len(calls):.0f}% / {count} / {errors} / "
+                f"{total / count * 1000:.0f}ms / {size // 1024}KB"
+            )
+        return "\n".join(lines)
+
+    def slow_log(self, limit=20):
+        with self.lock:
+            slow = list(self.slow)[-limit:]
+        if not slow:
+            return f"No calls slower than {API_SLOW_SECONDS}s"
+        return "\n".join(
+            f"• {datetime.fromtimestamp(at).strftime('%H:%M:%S')} {method} → {chat_id or '-'}: "
+            f"{seconds * 1000:.0f}ms{' ' + error if error else ''}"
+            for at, method, chat_id, seconds, size, error in reversed(slow)
+        )
+
+    def export_csv(self):
+        with self.lock:
+            calls = list(self.calls)
+        text = StringIO()
+        writer = csv.writer(text)
+        writer.writerow(["time", "method", "chat_id", "seconds", "bytes", "error"])
+        for at, method, chat_id, seconds, size, error in calls:
+            writer.writerow([datetime.fromtimestamp(at).isoformat(), method, chat_id, f"{seconds:.4f}", size, error])
+        return BytesIO(text.getvalue().encode())
+
+api_tracer = ApiTracer(API_TRACE_SIZE)
+
+def traced_sync_request(make_request):
+    def traced(token, method_name, method='get', params=None, files=None):
+        chat_id = (params or {}).get("chat_id")
+        response_bytes.set(0)
+        started = time.perf_counter()
+        error = ""
+        try:
+            return make_request(token, method_name, method, params, files)
+        except Exception as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            api_tracer.record(method_name, chat_id, time.perf_counter() - started, response_bytes.get(), error)
+    return traced
+
+def traced_async_request(process_request):
+    async def traced(token, url, method='get', params=None, files=None, **kwargs):
+        chat_id = (params or {}).get("chat_id")
+        response_bytes.set(0)
+        started = time.perf_counter()
+        error = ""
+        try:
+            return await process_request(token, url, method, params, files, **kwargs)
+        except Exception as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            api_tracer.record(url, chat_id, time.perf_counter() - started, response_bytes.get(), error)
+    return traced
+
+telebot.apihelper._make_request = traced_sync_request(telebot.apihelper._make_request)
 
 # ===============================
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# ============ METRICS ============
+# Prometheus text format on METRICS_PORT. Hot paths only bump counters;
+# gauges (queue depths, sizes) are read by collectors at scrape time.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # 0 = disabled
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")  # 0.0.0.0 only if the scraper is remote and trusted
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.lock = threading.Lock()
+        self.values = {}  # label values tuple -> count
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{metric_labels(zip(self.labels, key))} {value}" for key, value in values]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.label, self.buckets = name, help_text, label, buckets
+        self.lock = threading.Lock()
+        self.series = {}  # label value -> [bucket counts, count, sum]
+
+    def observe(self, label_value, seconds):
+        idx = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            entry = self.series.get(label_value)
+            if entry is None:
+                entry = self.series[label_value] = [[0] * len(self.buckets), 0, 0.0]
+            if idx < len(self.buckets):
+                entry[0][idx] += 1
+            entry[1] += 1
+            entry[2] += seconds
+
+    def render(self):
+        with self.lock:
+            series = [(key, list(counts), count, total) for key, (counts, count, total) in self.series.items()]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, counts, count, total in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{metric_labels([(self.label, key), ('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{metric_labels([(self.label, key), ('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{metric_labels([(self.label, key)])} {total:.6f}")
+            lines.append(f"{self.name}_count{metric_labels([(self.label, key)])} {count}")
+        return lines
+
+def metric_labels(pairs):
+    text = ",".join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in pairs)
+    return "{" + text + "}" if text else ""
+
+def gauge_lines(name, help_text, samples):
+    """samples: [(label pairs, value)]"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{metric_labels(pairs)} {value}" for pairs, value in samples]
+    return lines
+
+handler_latency = Histogram("bot_handler_seconds", "Update handler and deferred work latency", "handler")
+handler_errors = Counter("bot_handler_errors_total", "Handlers that raised", ("handler",))
+broadcast_deliveries = Counter("bot_broadcast_deliveries_total", "Broadcast recipients by outcome", ("outcome",))
+save_latency = Histogram("bot_save_seconds", "save_all_data duration", "store")
+metrics_collectors = []  # callables returning exposition lines, run per scrape
+
+# Recent per-handler latency for /perf: log-scale buckets (0.1ms..~60s,
+# ~26% apart) counted in 10-second slots, PERF_WINDOW_SECONDS kept per handler
+PERF_SLOT_SECONDS = 10
+PERF_WINDOW_SECONDS = 15 * 60
+PERF_BUCKETS = [0.0001 * 10 ** (i / 10) for i in range(58)]
+
+class LatencyWindow:
+    def __init__(self):
+        self.slots = [[-1, None] for _ in range(PERF_WINDOW_SECONDS // PERF_SLOT_SECONDS)]  # [slot number, bucket counts]
+
+    def record(self, seconds, now):
+        number = int(now // PERF_SLOT_SECONDS)
+        slot = self.slots[number % len(self.slots)]
+        if slot[0] != number:
+            slot[0], slot[1] = number, [0] * (len(PERF_BUCKETS) + 1)
+        slot[1][bisect.bisect_left(PERF_BUCKETS, seconds)] += 1
+
+    def merged(self, window_seconds, now):
+        newest = int(now // PERF_SLOT_SECONDS)
+        oldest = newest - window_seconds // PERF_SLOT_SECONDS
+        total = [0] * (len(PERF_BUCKETS) + 1)
+        for number, counts in self.slots:
+            if oldest < number <= newest:
+                for idx, count in enumerate(counts):
+                    total[idx] += count
+        return total
+
+def bucket_percentile(counts, quantile):
+    """Upper bound of the bucket holding the quantile (seconds)"""
+    target = quantile * sum(counts)
+    running = 0
+    for idx, count in enumerate(counts):
+        running += count
+        if running >= target and count:
+            return PERF_BUCKETS[idx] if idx < len(PERF_BUCKETS) else float("inf")
+    return 0.0
+
+class PerfStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {}  # handler -> LatencyWindow
+
+    def record(self, name, seconds):
+        with self.lock:
+            window = self.windows.get(name)
+            if window is None:
+                window = self.windows[name] = LatencyWindow()
+            window.record(seconds, time.time())
+
+    def report(self, window_seconds):
+        """[(handler, calls, p50, p95, p99)] busiest first"""
+        now = time.time()
+        with self.lock:
+            merged = [(name, window.merged(window_seconds, now)) for name, window in self.windows.items()]
+        rows = [
+            (name, sum(counts), bucket_percentile(counts, 0.5), bucket_percentile(counts, 0.95), bucket_percentile(counts, 0.99))
+            for name, counts in merged if sum(counts)
+        ]
+        return sorted(rows, key=lambda row: -row[1])
+
+perf_stats = PerfStats()
+
+def observe_handler(name, seconds):
+    handler_latency.observe(name, seconds)
+    perf_stats.record(name, seconds)
+
+def render_metrics():
+    lines = []
+    for metric in (handler_latency, handler_errors, broadcast_deliveries, save_latency):
+        lines += metric.render()
+    for collector in metrics_collectors:
+        try:
+            lines += collector()
+        except Exception as e:
+            logging.error(f"Metrics collector error: {e}")
+    return "\n".join(lines) + "\n"
+
+def collect_transport_metrics():
+    with transport_stats.lock:
+        statuses = list(transport_stats.statuses.items())
+        methods = [(method, entry[0], entry[2]) for method, entry in transport_stats.methods.items()]
+        connections = transport_stats.connections_opened
+    lines = ["# HELP bot_api_requests_total Bot API calls by method and HTTP status (0 = no response)",
+             "# TYPE bot_api_requests_total counter"]
+    lines += [f"bot_api_requests_total{metric_labels([('method', method), ('status', status)])} {count}"
+              for (method, status), count in statuses]
+    lines += ["# HELP bot_api_rate_limited_total Bot API calls answered with 429", "# TYPE bot_api_rate_limited_total counter",
+              f"bot_api_rate_limited_total {sum(count for (_, status), count in statuses if status == 429)}"]
+    lines += ["# HELP bot_api_request_seconds Bot API call latency", "# TYPE bot_api_request_seconds summary"]
+    for method, calls, total in methods:
+        lines.append(f"bot_api_request_seconds_sum{metric_labels([('method', method)])} {total:.6f}")
+        lines.append(f"bot_api_request_seconds_count{metric_labels([('method', method)])} {calls}")
+    lines += ["# HELP bot_http_connections_opened_total New HTTP connections (handshakes)",
+              "# TYPE bot_http_connections_opened_total counter", f"bot_http_connections_opened_total {connections}"]
+    return lines
+
+metrics_collectors.append(collect_transport_metrics)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    """Serve /metrics on METRICS_PORT (if set)"""
+    if not METRICS_PORT:
+        return None
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# ========== GC PAUSES ==========
+# Every cyclic collection is timed through gc.callbacks. GC_FREEZE=1 moves the
+# heap built by load_data() into the permanent generation once startup is done,
+# so later collections stop rescanning millions of long-lived user dicts.
+GC_FREEZE = os.environ.get("GC_FREEZE", "0") == "1"
+GC_THRESHOLDS = os.environ.get("GC_THRESHOLDS", "")  # "gen0,gen1,gen2"; GC_FREEZE alone uses 50000,20,20
+GC_PAUSE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+class GcPauseHistogram(Histogram):
+    """Histogram fed from inside the collector. observe() takes no lock: the
+    collection may have been triggered by an allocation made while that very
+    lock was held, and collections never overlap, so the GIL is enough."""
+    def __init__(self, name, help_text, label, buckets):
+        super().__init__(name, help_text, label, buckets)
+        self.series = {str(gen): [[0] * len(buckets), 0, 0.0] for gen in range(3)}
+        self.worst = [0.0, 0.0, 0.0]
+        self.collected = [0, 0, 0]
+        self.started = 0.0
+
+    def observe(self, label_value, seconds):
+        entry = self.series[label_value]
+        idx = bisect.bisect_left(self.buckets, seconds)
+        if idx < len(self.buckets):
+            entry[0][idx] += 1
+        entry[1] += 1
+        entry[2] += seconds
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.started = time.perf_counter()
+            return
+        pause = time.perf_counter() - self.started
+        generation = info["generation"]
+        self.observe(str(generation), pause)
+        self.collected[generation] += info["collected"]
+        if pause > self.worst[generation]:
+            self.worst[generation] = pause
+
+    def summary(self):
+        """[(generation, collections, total seconds, worst seconds)]"""
+        return [(gen, self.series[str(gen)][1], self.series[str(gen)][2], self.worst[gen]) for gen in range(3)]
+
+gc_pauses = GcPauseHistogram("bot_gc_pause_seconds", "Cyclic garbage collector pause by generation", "generation", GC_PAUSE_BUCKETS)
+gc.callbacks.append(gc_pauses.callback)
+
+def tune_gc(freeze=GC_FREEZE):
+    """Apply GC_THRESHOLDS and, in freeze mode, collect once and freeze the heap"""
+    thresholds = GC_THRESHOLDS or ("50000,20,20" if freeze else "")
+    if thresholds:
+        gc.set_threshold(*(int(value) for value in thresholds.split(',')))
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    return gc.get_freeze_count()
+
+def collect_gc_metrics():
+    lines = gc_pauses.render()
+    lines += ["# HELP bot_gc_collected_total Objects freed by the cyclic collector", "# TYPE bot_gc_collected_total counter"]
+    lines += [f"bot_gc_collected_total{metric_labels([('generation', gen)])} {count}" for gen, count in enumerate(gc_pauses.collected)]
+    lines += gauge_lines("bot_gc_counts", "gc.get_count(): gen0 net allocations, gen1/gen2 younger collections since last run",
+                         [([("generation", gen)], count) for gen, count in enumerate(gc.get_count())])
+    lines += gauge_lines("bot_gc_frozen_objects", "Objects moved to the permanent generation by gc.freeze()",
+                         [([], gc.get_freeze_count())])
+    return lines
+
+metrics_collectors.append(collect_gc_metrics)
+
+# ========== SAMPLING PROFILER ==========
+# /profile polls sys._current_frames() from its own thread. No trace hooks are
+# installed, so the only cost is one stack walk per thread per sample.
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "10"))
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", "120"))
+PROFILE_MAX_DEPTH = 64
+PROFILE_IDLE_FILES = ("threading.py", "selectors.py")  # leaf frames that are just waiting
+
+class SamplingProfiler:
+    """Aggregates every thread's stack into collapsed "thread;outer;...;leaf" counts"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()  # one profile at a time
+        self.labels = {}
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def run(self, seconds):
+        """Sample for `seconds`; None if a profile is already running"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            me = threading.get_ident()
+            stacks = {}
+            samples = 0
+            walking = 0.0
+            started = time.perf_counter()
+            deadline = started + seconds
+            while time.perf_counter() < deadline:
+                tick = time.perf_counter()
+                names = {thread.ident: thread.name.replace(';', '_') for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    parts = []
+                    while frame is not None and len(parts) < PROFILE_MAX_DEPTH:
+                        parts.append(self.label(frame.f_code))
+                        frame = frame.f_back
+                    if frame is not None:
+                        parts.append("…")
+                    parts.append(names.get(ident, f"thread-{ident}"))
+                    key = ";".join(reversed(parts))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                walking += time.perf_counter() - tick
+                time.sleep(self.interval)
+            return {"stacks": stacks, "samples": samples, "elapsed": time.perf_counter() - started, "walking": walking}
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def collapsed(result):
+        """flamegraph.pl / speedscope input"""
+        lines = [f"{stack} {count}" for stack, count in sorted(result["stacks"].items(), key=lambda item: -item[1])]
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def top_functions(result, limit=15):
+        """[(label, self_samples, total_samples)] over non-idle stacks, plus the idle sample count"""
+        own, total = {}, {}
+        idle = 0
+        for stack, count in result["stacks"].items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            if frames[-1].split("(")[-1].startswith(PROFILE_IDLE_FILES):
+                idle += count
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for label in set(frames):
+                total[label] = total.get(label, 0) + count
+        rows = sorted(total, key=lambda label: (-own.get(label, 0), -total[label]))[:limit]
+        return [(label, own.get(label, 0), total[label]) for label in rows], idle
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+# ========== MEMORY INTROSPECTION ==========
+# /mem: estimated deep size per global store, threads, and a tracemalloc diff.
+# Tracing slows every allocation, so it is off unless MEM_TRACE=1 (baseline
+# when polling starts) or an admin runs /mem trace (baseline from then on).
+MEM_TRACE = os.environ.get("MEM_TRACE", "0") == "1"
+MEM_TRACE_FRAMES = int(os.environ.get("MEM_TRACE_FRAMES", "1"))
+MEM_SAMPLE_ITEMS = 2000  # containers bigger than this are sampled and scaled up
+MEM_OPAQUE = (type, type(sys), type(len), type(lambda: None), type(print.__call__), threading.Thread,
+              ThreadPoolExecutor, ProcessPoolExecutor, telebot.TeleBot)
+
+def deep_size(obj, seen=None):
+    """Approximate bytes reachable from obj; big containers are stride-sampled.
+    Handlers keep mutating the stores, so containers are walked from a
+    snapshot of their keys / items (list() of a builtin is atomic under the GIL)."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, MEM_OPAQUE):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (dict, list, tuple, set, frozenset, deque)):
+        children = list(obj)
+    elif hasattr(obj, '__dict__'):
+        return size + deep_size(vars(obj), seen)
+    else:
+        return size
+    step = max(1, len(children) // MEM_SAMPLE_ITEMS)
+    measured = 0
+    sampled = 0
+    for child in children[::step]:
+        measured += deep_size(child, seen)
+        if isinstance(obj, dict):
+            # Missing if deleted since the snapshot: counts as an empty slot
+            measured += deep_size(obj.get(child), seen)
+        sampled += 1
+    return size + (measured * len(children) // sampled if sampled else 0)
+
+def memory_stores():
+    """(name, object) for every long-lived store worth accounting"""
+    return [
+        ("users_data", users_data),
+        ("spam_data", spam_data),
+        ("broadcast_queue", broadcast_queue),
+        ("start_message_data", start_message_data),
+        ("audience_index", audience_index),
+        ("delivery_dedupe", delivery_dedupe),
+        ("click_counter", click_counter),
+        ("payment_qr", payment_qr),
+        ("payment_verifier", payment_verifier),
+        ("log_pipeline", log_pipeline),
+        ("media_groups", media_groups),
+        ("api_tracer", api_tracer),
+        ("perf_stats", perf_stats),
+        ("telebot next_step", bot.next_step_backend),
+        ("telebot reply", bot.reply_backend),
+        ("telebot states", bot.current_states),
+    ]
+
+def process_rss():
+    """Resident set size in bytes (Linux /proc), 0 if unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def human_bytes(n):
+    for unit in ("B", "KB", "MB"):
+        if abs(n) < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}GB"
+
+mem_baseline = None
+
+def mem_trace_filters():
+    return (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>"))
+
+def start_mem_trace():
+    """Begin tracemalloc (if needed) and take the baseline snapshot /mem diffs against"""
+    global mem_baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(MEM_TRACE_FRAMES)
+    mem_baseline = tracemalloc.take_snapshot().filter_traces(mem_trace_filters())
+    return mem_baseline
+
+def stop_mem_trace():
+    global mem_baseline
+    mem_baseline = None
+    tracemalloc.stop()
+
+def mem_trace_diff(limit=10):
+    """Top allocation sites by growth since the baseline"""
+    if mem_baseline is None or not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces(mem_trace_filters())
+    return snapshot.compare_to(mem_baseline, "lineno")[:limit]
+
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", num_threads=BOT_WORKERS)
 
 # Initialize data storage
 start_message_data = {}
@@ -97,21 +897,21 @@ broadcast_queue = {}  # For storing media groups temporarily
 def load_data():
     """Load data from Railway persistent volume"""
     global start_message_data, users_data, spam_data, broadcast_queue
-    print("📂 Loading data from persistent storage...")
+    data_log.info("📂 Loading data from persistent storage...", extra={"event": "load", "data_dir": DATA_DIR})
     
     try:
         # Load start message
         if os.path.exists(START_MESSAGE_FILE):
             with open(START_MESSAGE_FILE, 'r') as f:
                 start_message_data = json.load(f)
-            print(f"✅ Loaded start message data")
+            data_log.info("✅ Loaded start message data", extra={"event": "load", "file": START_MESSAGE_FILE})
         else:
-            print("⚠️ No start message data found")
+            data_log.warning("⚠️ No start message data found", extra={"event": "load", "file": START_MESSAGE_FILE})
             start_message_data = {}
             with open(START_MESSAGE_FILE, 'w') as f:
                 json.dump(start_message_data, f)
     except Exception as e:
-        print(f"❌ Error loading start message: {e}")
+        data_log.error(f"❌ Error loading start message: {e}", extra={"event": "load", "file": START_MESSAGE_FILE})
         start_message_data = {}
     
     try:
@@ -119,14 +919,14 @@ def load_data():
         if os.path.exists(USERS_DATA_FILE):
             with open(USERS_DATA_FILE, 'r') as f:
                 users_data = json.load(f)
-            print(f"✅ Loaded {len(users_data)} users from {USERS_DATA_FILE}")
+            data_log.info(f"✅ Loaded {len(users_data)} users from {USERS_DATA_FILE}", extra={"event": "load", "file": USERS_DATA_FILE, "count": len(users_data)})
         else:
-            print("⚠️ No users data found, starting fresh")
+            data_log.warning("⚠️ No users data found, starting fresh", extra={"event": "load", "file": USERS_DATA_FILE})
             users_data = {}
             with open(USERS_DATA_FILE, 'w') as f:
                 json.dump(users_data, f)
     except Exception as e:
-        print(f"❌ Error loading users data: {e}")
+        data_log.error(f"❌ Error loading users data: {e}", extra={"event": "load", "file": USERS_DATA_FILE})
         users_data = {}
     
     try:
@@ -134,14 +934,14 @@ def load_data():
         if os.path.exists(SPAM_DATA_FILE):
             with open(SPAM_DATA_FILE, 'r') as f:
                 spam_data = json.load(f)
-            print(f"✅ Loaded spam data for {len(spam_data)} users")
+            data_log.info(f"✅ Loaded spam data for {len(spam_data)} users", extra={"event": "load", "file": SPAM_DATA_FILE, "count": len(spam_data)})
         else:
-            print("⚠️ No spam data found")
+            data_log.warning("⚠️ No spam data found", extra={"event": "load", "file": SPAM_DATA_FILE})
             spam_data = {}
             with open(SPAM_DATA_FILE, 'w') as f:
                 json.dump(spam_data, f)
     except Exception as e:
-        print(f"❌ Error loading spam data: {e}")
+        data_log.error(f"❌ Error loading spam data: {e}", extra={"event": "load", "file": SPAM_DATA_FILE})
         spam_data = {}
     
     try:
@@ -149,24 +949,24 @@ def load_data():
         if os.path.exists(BROADCAST_QUEUE_FILE):
             with open(BROADCAST_QUEUE_FILE, 'r') as f:
                 broadcast_queue = json.load(f)
-            print(f"✅ Loaded broadcast queue with {len(broadcast_queue)} items")
+            data_log.info(f"✅ Loaded broadcast queue with {len(broadcast_queue)} items", extra={"event": "load", "file": BROADCAST_QUEUE_FILE, "count": len(broadcast_queue)})
         else:
-            print("⚠️ No broadcast queue data found")
+            data_log.warning("⚠️ No broadcast queue data found", extra={"event": "load", "file": BROADCAST_QUEUE_FILE})
             broadcast_queue = {}
             with open(BROADCAST_QUEUE_FILE, 'w') as f:
                 json.dump(broadcast_queue, f)
     except Exception as e:
-        print(f"❌ Error loading broadcast queue: {e}")
+        data_log.error(f"❌ Error loading broadcast queue: {e}", extra={"event": "load", "file": BROADCAST_QUEUE_FILE})
         broadcast_queue = {}
     
-    print(f"📊 Total users in memory: {len(users_data)}")
+    data_log.info(f"📊 Total users in memory: {len(users_data)}", extra={"event": "load", "users": len(users_data)})
 
 def save_start_message():
     """Save start message to Railway persistent volume"""
     try:
         with open(START_MESSAGE_FILE, 'w') as f:
             json.dump(start_message_data, f, indent=4)
-        print("💾 Start message saved")
+        data_log.debug("💾 Start message saved", extra={"event": "save", "file": START_MESSAGE_FILE})
     except Exception as e:
         logging.error(f"Error saving start message: {e}")
 
@@ -175,7 +975,7 @@ def save_users_data():
     try:
         with open(USERS_DATA_FILE, 'w') as f:
             json.dump(users_data, f, indent=4)
-        print(f"💾 Users data saved ({len(users_data)} users)")
+        data_log.debug(f"💾 Users data saved ({len(users_data)} users)", extra={"event": "save", "file": USERS_DATA_FILE, "count": len(users_data)})
     except Exception as e:
         logging.error(f"Error saving users data: {e}")
 
@@ -190,18 +990,31 @@ def save_spam_data():
 def save_broadcast_queue():
     """Save broadcast queue to Railway persistent volume"""
     try:
+        # Snapshot under the session lock so handlers can keep mutating it
+        with album_sessions.lock:
+            payload = json.dumps(broadcast_queue, indent=4)
+            album_sessions.dirty = False
         with open(BROADCAST_QUEUE_FILE, 'w') as f:
-            json.dump(broadcast_queue, f, indent=4)
+            f.write(payload)
     except Exception as e:
         logging.error(f"Error saving broadcast queue: {e}")
 
+DATA_FILES = (START_MESSAGE_FILE, USERS_DATA_FILE, SPAM_DATA_FILE, BROADCAST_QUEUE_FILE, LOG_QUEUE_FILE)
+last_save_bytes = 0
+
 def save_all_data():
     """Save all data at once"""
+    global last_save_bytes
+    started = time.perf_counter()
     save_start_message()
     save_users_data()
     save_spam_data()
     save_broadcast_queue()
-    print("💾 All data saved successfully")
+    log_pipeline.save()
+    elapsed = time.perf_counter() - started
+    save_latency.observe("all", elapsed)
+    last_save_bytes = sum(os.path.getsize(path) for path in DATA_FILES if os.path.exists(path))
+    data_log.info("💾 All data saved successfully", extra={"event": "auto_save", "ms": round(elapsed * 1e3, 2), "bytes": last_save_bytes})
 
 # Load data on startup
 load_data()
@@ -209,12 +1022,19 @@ load_data()
 # Auto-save thread function
 def auto_save_data():
     """Automatically save data every 30 seconds"""
+    last_prune = 0
     while True:
         time.sleep(30)
         try:
+            album_sessions.expire()
+            delivery_dedupe.expire()
+            click_counter.flush()
             save_all_data()
+            if time.time() - last_prune >= JOB_PRUNE_SECONDS:
+                last_prune = time.time()
+                BroadcastJob.prune()
         except Exception as e:
-            print(f"❌ Auto-save error: {e}")
+            data_log.exception(f"❌ Auto-save error: {e}", extra={"event": "auto_save"})
 
 # Start auto-save thread
 auto_save_thread = threading.Thread(target=auto_save_data, daemon=True)
@@ -303,6 +1123,7 @@ def check_spam(user_id):
     
     # Update activity and get request count
     request_count = update_user_activity(user_id)
+    spam_log.info("spam check", extra={"event": "spam_check", "user_id": user_id_str, "requests": request_count})
     
     # Ensure all keys exist
     if "warnings" not in spam_data[user_id_str]:
@@ -321,6 +1142,8 @@ def check_spam(user_id):
         user_data["blocked_until"] = current_time + block_duration
         user_data["requests"] = []  # Reset requests after blocking
         user_data["warnings"] = 0
+        audience_index.record_block(user_id_str, user_data["blocked_until"])
+        spam_log.warning("⛔ User blocked for spam", extra={"event": "spam_block", "user_id": user_id_str, "block_level": user_data["block_level"], "requests": request_count})
         
         # Notify admin
         try:
@@ -395,6 +1218,7 @@ def ban_user(user_id, duration_seconds, reason="", banned_by=ADMIN_ID):
     spam_data[user_id_str]["ban_reason"] = reason
     spam_data[user_id_str]["banned_by"] = banned_by
     spam_data[user_id_str]["block_level"] = 3  # Mark as admin ban
+    audience_index.record_block(user_id_str, spam_data[user_id_str]["blocked_until"])
     
     # Try to notify the user
     try:
@@ -425,7 +1249,7 @@ def ban_user(user_id, duration_seconds, reason="", banned_by=ADMIN_ID):
 # Initialize spam_data for all existing users on startup
 def initialize_spam_data():
     """Ensure all existing users have spam_data entries"""
-    print("🔄 Initializing spam data for existing users...")
+    spam_log.info("🔄 Initializing spam data for existing users...", extra={"event": "spam_init"})
     initialized = 0
     for user_id_str in users_data.keys():
         if user_id_str not in spam_data:
@@ -440,11 +1264,187 @@ def initialize_spam_data():
             initialized += 1
     
     if initialized > 0:
-        print(f"✅ Initialized spam data for {initialized} users")
+        spam_log.info(f"✅ Initialized spam data for {initialized} users", extra={"event": "spam_init", "count": initialized})
 
 # Initialize spam data on startup
 initialize_spam_data()
 
+# ============ AUDIENCE SEGMENTS ============
+SEGMENT_HELP = """
+<b>🎯 Audience Segments</b>
+
+• <code>all</code> - every user (default)
+• <code>new:7</code> - joined in the last 7 days
+• <code>nopay</code> - clicked Get Premium but never Payment Done
+• <code>active</code> - not blocked right now
+• <code>ids:111,222</code> - explicit user ids
+
+Combine terms with spaces, e.g. <code>new:3 nopay active</code>
+"""
+
+class AudienceIndex:
+    """Incrementally maintained indexes used to build broadcast target lists"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.join_times = []  # sorted join timestamps
+        self.join_ids = []  # user ids, aligned with join_times
+        self.known = set()
+        self.clicked_premium = set()
+        self.payment_done = set()
+        self.blocked_until = {}
+
+    def rebuild(self):
+        """Build all indexes from users_data and spam_data (startup / import)"""
+        entries = []
+        clicked = set()
+        paid = set()
+        for user_id_str, user in users_data.items():
+            entries.append((user_joined_at(user), user_id_str))
+            if user.get('clicked_premium_at'):
+                clicked.add(user_id_str)
+            if user.get('payment_done_at'):
+                paid.add(user_id_str)
+        entries.sort()
+
+        now = time.time()
+        blocked = {
+            uid: data.get("blocked_until", 0)
+            for uid, data in spam_data.items()
+            if data.get("blocked_until", 0) > now
+        }
+
+        with self.lock:
+            self.join_times = [ts for ts, _ in entries]
+            self.join_ids = [uid for _, uid in entries]
+            self.known = set(self.join_ids)
+            self.clicked_premium = clicked
+            self.payment_done = paid
+            self.blocked_until = blocked
+
+    def record_join(self, user_id_str, joined_at):
+        with self.lock:
+            if user_id_str in self.known:
+                return
+            self.known.add(user_id_str)
+            # New users almost always arrive in time order, so this is an append
+            pos = bisect.bisect_right(self.join_times, joined_at)
+            self.join_times.insert(pos, joined_at)
+            self.join_ids.insert(pos, user_id_str)
+
+    def record_premium_click(self, user_id_str):
+        with self.lock:
+            self.clicked_premium.add(user_id_str)
+
+    def record_payment_done(self, user_id_str):
+        with self.lock:
+            self.payment_done.add(user_id_str)
+
+    def record_block(self, user_id_str, blocked_until):
+        with self.lock:
+            self.blocked_until[user_id_str] = blocked_until
+
+    def blocked_now(self):
+        """Currently blocked user ids (expired blocks are pruned on the way)"""
+        now = time.time()
+        with self.lock:
+            expired = [uid for uid, until in self.blocked_until.items() if until <= now]
+            for uid in expired:
+                del self.blocked_until[uid]
+            return set(self.blocked_until)
+
+    def joined_since(self, since_ts):
+        with self.lock:
+            pos = bisect.bisect_left(self.join_times, since_ts)
+            return self.join_ids[pos:]
+
+    def all_ids(self):
+        with self.lock:
+            return list(self.join_ids)
+
+def user_joined_at(user):
+    """First-seen timestamp of a user record (falls back to start_time)"""
+    joined_at = user.get('joined_at')
+    if joined_at:
+        return joined_at
+    try:
+        return datetime.fromisoformat(user.get('start_time', '')).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+def parse_segment(spec):
+    """Parse a segment string like 'new:7 nopay' into a list of (term, value)"""
+    terms = []
+    for token in (spec or "").lower().split():
+        name, _, value = token.partition(':')
+        if name == "all":
+            continue
+        elif name in ("new", "joined"):
+            days = float(value)
+            if days <= 0:
+                raise ValueError("new:DAYS must be a positive number of days")
+            terms.append(("new", days))
+        elif name == "nopay":
+            terms.append(("nopay", None))
+        elif name in ("active", "notblocked"):
+            terms.append(("active", None))
+        elif name == "ids":
+            ids = [uid.strip() for uid in value.split(',') if uid.strip()]
+            if not ids or not all(uid.isdigit() for uid in ids):
+                raise ValueError("ids:ID,ID,... must be numeric user ids")
+            terms.append(("ids", ids))
+        else:
+            raise ValueError(f"Unknown segment term: {token}")
+    return terms
+
+def build_audience(spec=""):
+    """Build the target user id list for a segment spec"""
+    terms = parse_segment(spec)
+
+    # Start from the narrowest ordered source, then filter with set lookups
+    candidates = None
+    filters = []
+    for name, value in terms:
+        if name == "new":
+            ids = audience_index.joined_since(time.time() - value * 86400)
+        elif name == "ids":
+            ids = [uid for uid in dict.fromkeys(value) if uid in users_data]
+        else:
+            ids = None
+
+        if ids is not None:
+            if candidates is None:
+                candidates = ids
+            else:
+                filters.append(set(ids))
+        elif name == "nopay":
+            with audience_index.lock:
+                filters.append(audience_index.clicked_premium - audience_index.payment_done)
+        elif name == "active":
+            blocked = audience_index.blocked_now()
+            if blocked:
+                filters.append(lambda uid, blocked=blocked: uid not in blocked)
+
+    if candidates is None:
+        # nopay is usually far smaller than the user base - use it directly
+        set_filters = [f for f in filters if isinstance(f, set)]
+        if set_filters:
+            smallest = min(set_filters, key=len)
+            filters.remove(smallest)
+            candidates = list(smallest)
+        else:
+            candidates = audience_index.all_ids()
+
+    for f in filters:
+        if isinstance(f, set):
+            candidates = [uid for uid in candidates if uid in f]
+        else:
+            candidates = [uid for uid in candidates if f(uid)]
+
+    return candidates
+
+audience_index = AudienceIndex()
+audience_index.rebuild()
+
 class PremiumBot:
     def __init__(self):
         self.logger = logging.getLogger(__name__)
@@ -474,32 +1474,313 @@ class PremiumBot:
         keyboard.add(btn1, btn2)
         return keyboard
     
-    def generate_qr_code(self, upi_id, amount, name):
+    def tier_keyboard(self):
+        """One button per price tier"""
+        keyboard = types.InlineKeyboardMarkup(row_width=1)
+        for key, (label, amount) in PRICE_TIERS.items():
+            keyboard.add(types.InlineKeyboardButton(f"💎 {label} - ₹{amount}", callback_data=f"tier_{key}"))
+        return keyboard
+    
+    def upi_url(self, upi_id, amount, name, note=None, ref=None):
+        """UPI deep link; note/ref fill the tn (transaction note) and tr (reference) params"""
+        url = f"upi://pay?pa={upi_id}&pn={quote(name)}&am={amount}&cu=INR"
+        if note:
+            url += f"&tn={quote(note)}"
+        if ref:
+            url += f"&tr={quote(ref)}"
+        return url
+    
+    def generate_qr_code(self, upi_id, amount, name, note=None, ref=None):
         """Generate UPI QR code"""
         try:
-            upi_url = f"upi://pay?pa={upi_id}&pn={name}&am={amount}&cu=INR"
-            qr = qrcode.QRCode(version=1, box_size=10, border=4)
-            qr.add_data(upi_url)
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
-            img_bytes = BytesIO()
-            img.save(img_bytes, format='PNG')
-            img_bytes.seek(0)
-            return img_bytes
+            return BytesIO(render_qr_png(self.upi_url(upi_id, amount, name, note, ref)))
         except Exception as e:
             self.logger.error(f"QR Error: {e}")
             return None
 
+def payment_ref(user_id, tier_key):
+    """UPI transaction reference (tr) for the user's next purchase of a tier.
+    HMAC-derived so it can't be guessed from the user id; stable until that
+    user's next confirmed payment, so the cached QR stays reusable."""
+    paid = len(users_data.get(str(user_id), {}).get("payments", []))
+    digest = hmac.new(PAYMENT_REF_SECRET.encode(), f"{user_id}:{tier_key}:{paid}".encode(), hashlib.sha256).hexdigest()
+    return f"{tier_key[:8].upper()}{digest[:12].upper()}"
+
+def price_summary():
+    """₹99 for one tier, "₹99 / ₹199" for several"""
+    return " / ".join(f"₹{amount}" for _, amount in PRICE_TIERS.values())
+
 premium_bot = PremiumBot()
 
-# ========== IMPORTANT LOGS ONLY ==========
-def log_important_event(event_type, user_data=None):
-    """Sirf important events log karo"""
-    try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# ========== PAYMENT QR CACHE ==========
+class PaymentQRCache:
+    """LRU of payment QRs keyed by UPI URL: the rendered PNG plus the Telegram
+    file_id of its first upload, so repeat requests send only a file reference.
+    file_ids are persisted; misses render on a process pool (PIL holds the GIL)."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # url -> {"png": bytes|None, "file_id": str|None}
+        self.rendering = {}  # url -> Future, so concurrent misses render once
+        self.pool = qr_render_pool  # None: render inline
+        self.hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+        self.render_times = deque(maxlen=200)
+        self.load()
+
+    def load(self):
+        try:
+            with open(QR_CACHE_FILE, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for url, file_id in data.get("file_ids", {}).items():
+            self.entries[url] = {"png": None, "file_id": file_id}
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        with self.lock:
+            file_ids = {url: entry["file_id"] for url, entry in self.entries.items() if entry["file_id"]}
+        try:
+            with open(QR_CACHE_FILE, 'w') as f:
+                json.dump({"file_ids": file_ids}, f)
+        except Exception as e:
+            logging.error(f"Error saving QR cache: {e}")
+
+    def _render(self, url):
+        """Render on the process pool, inline if the pool is unavailable"""
+        started = time.perf_counter()
+        pool = self.pool
+        try:
+            png = pool.submit(render_qr_png, url).result(timeout=10) if pool else render_qr_png(url)
+        except Exception as e:
+            logging.error(f"QR render pool error, rendering inline from now on: {e}")
+            # Never re-create it: forking now would copy this process's threads' locks
+            with self.lock:
+                self.pool = None
+            try:
+                png = render_qr_png(url)
+            except Exception as e:
+                logging.error(f"QR Error: {e}")
+                png = None
+        self.render_times.append(time.perf_counter() - started)
+        return png
+
+    def _entry(self, url):
+        """(file_id, png) for a UPI URL, rendering on a miss"""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and (entry["file_id"] or entry["png"]):
+                self.entries.move_to_end(url)
+                self.hits += 1
+                return entry["file_id"], entry["png"]
+            self.misses += 1
+            future = self.rendering.get(url)
+            owner = future is None
+            if owner:
+                future = self.rendering[url] = Future()
         
-        if event_type == "new_user":
-            log_msg = f"""
+        if owner:
+            png = self._render(url)
+            with self.lock:
+                del self.rendering[url]
+                if png:
+                    self._store(url, png=png)
+            future.set_result(png)
+        return None, future.result()
+
+    def _store(self, url, **fields):
+        """Update an entry (caller holds the lock) and evict past capacity"""
+        entry = self.entries.setdefault(url, {"png": None, "file_id": None})
+        entry.update(fields)
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def send(self, chat_id, url, caption, reply_markup):
+        """Send the QR photo; False if it could not be rendered"""
+        file_id, png = self._entry(url)
+        if file_id:
+            try:
+                bot.send_photo(chat_id, photo=file_id, caption=caption, reply_markup=reply_markup)
+                with self.lock:
+                    self.file_id_hits += 1
+                return True
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                # Telegram no longer knows the file - upload it again
+                logging.error(f"Cached QR file_id rejected: {e.description}")
+                with self.lock:
+                    self.entries.pop(url, None)
+                file_id, png = self._entry(url)
+        if not png:
+            return False
+        
+        sent = bot.send_photo(chat_id, photo=BytesIO(png), caption=caption, reply_markup=reply_markup)
+        with self.lock:
+            self._store(url, file_id=sent.photo[-1].file_id)
+        self.save()
+        return True
+
+    def summary(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            times = sorted(self.render_times)
+            text = (
+                f"🗂 Entries: {len(self.entries)}/{self.capacity} | Render processes: {QR_RENDER_PROCESSES if self.pool else 'off (inline)'}\n"
+                f"🎯 Hit rate: {self.hits / lookups * 100 if lookups else 0:.1f}% "
+                f"({self.hits} hits, {self.misses} misses, {self.file_id_hits} sent by file_id)"
+            )
+        if times:
+            p50 = times[len(times) // 2] * 1000
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))] * 1000
+            text += f"\n⏱ Render: p50 {p50:.0f}ms | p95 {p95:.0f}ms | max {times[-1] * 1000:.0f}ms ({len(times)} recent)"
+        return text
+
+payment_qr = PaymentQRCache(QR_CACHE_SIZE)
+
+# ========== RESPONSE TEMPLATES ==========
+# Texts and keyboards depend only on config and the custom start message, so
+# they are built once. Markups are kept as their JSON: telebot sends a str
+# reply_markup as-is. Call responses.rebuild() when either source changes.
+START_MEDIA_METHODS = {"photo": "send_photo", "video": "send_video", "document": "send_document", "animation": "send_animation"}
+
+def split_at_ref(text):
+    """(head, tail) around the {ref} marker - per-user refs cost one join"""
+    head, _, tail = text.partition("{ref}")
+    return head, tail
+
+class ResponseRegistry:
+    def __init__(self):
+        self.compiled = {}
+        self.rebuild()
+
+    def __getitem__(self, name):
+        return self.compiled[name]
+
+    def for_user(self, name, user_id):
+        """Per-tier text for the tier this user last picked"""
+        variants = self.compiled[name]
+        return variants.get(users_data.get(str(user_id), {}).get("tier"), variants[None])
+
+    def rebuild(self):
+        main_menu = premium_bot.main_menu_keyboard().to_json()
+        compiled = {
+            "main_menu_markup": main_menu,
+            "payment_markup": premium_bot.payment_keyboard().to_json(),
+            "after_payment_markup": premium_bot.after_payment_keyboard().to_json(),
+            "tier_markup": premium_bot.tier_keyboard().to_json(),
+            "tier_prompt": "<b>💎 CHOOSE YOUR PLAN</b>",
+            "how_to": f"""
+<b>❓ HOW TO GET PREMIUM:</b>
+
+1. Click "Get Premium" button
+2. Scan QR code and pay {price_summary()}
+3. Click "Payment Done" button
+4. Wait for the payment confirmation
+
+<b>Support:</b> @{SUPPORT_USERNAME}
+    """,
+            "qr_caption": {},
+            "manual_payment": {},
+            "payment_failed": {None: self._failed_text(price_summary())},
+            "payment_success": {None: self._success_text(price_summary())}
+        }
+        
+        for key, (label, amount) in PRICE_TIERS.items():
+            compiled["qr_caption"][key] = split_at_ref(f"""
+<b>💰 PAY ₹{amount} FOR {html.escape(label.upper())}</b>
+
+<b>UPI Details:</b>
+└ ID: <code>{UPI_ID}</code>
+└ Name: {UPI_NAME}
+└ Amount: <b>₹{amount}</b>
+└ Ref: <code>{{ref}}</code>
+
+<b>Instructions:</b>
+1. Scan QR with any UPI app
+2. Pay ₹{amount}
+3. Click "Payment Done" below
+    """)
+            compiled["manual_payment"][key] = split_at_ref(f"""
+<b>💰 PAY ₹{amount}</b>
+
+<b>UPI ID:</b> <code>{UPI_ID}</code>
+<b>Amount:</b> ₹{amount}
+<b>Note:</b> <code>{{ref}}</code>
+
+<b>Steps:</b>
+1. Send ₹{amount} to above UPI ID
+2. Click "Payment Done"
+        """)
+            compiled["payment_failed"][key] = self._failed_text(f"₹{amount}")
+            compiled["payment_success"][key] = self._success_text(f"₹{amount}")
+        
+        compiled["start"] = self._start_request(main_menu)
+        self.compiled = compiled  # One swap: handlers never see a half-built set
+
+    @staticmethod
+    def _failed_text(price):
+        return f"""
+<b>❌ PAYMENT NOT RECEIVED</b>
+
+<b>What to do:</b>
+1. Check payment in UPI app
+2. Ensure {price} sent to <code>{UPI_ID}</code>
+3. Try payment again
+4. Contact @{SUPPORT_USERNAME}
+        """
+
+    @staticmethod
+    def _success_text(price):
+        return f"""
+<b>✅ PAYMENT RECEIVED</b>
+
+Thank you! Your {price} payment is confirmed.
+Premium access will be shared with you shortly.
+
+<b>Support:</b> @{SUPPORT_USERNAME}
+        """
+
+    @staticmethod
+    def _start_request(main_menu):
+        """(method, kwargs) that sends the /start message"""
+        data = start_message_data
+        if data and 'has_media' in data:
+            text = data.get('text', "")
+            if not data['has_media']:
+                return "send_message", {"text": text, "reply_markup": main_menu, "parse_mode": "HTML"}
+            method = START_MEDIA_METHODS.get(data.get('media_type', ''))
+            if method and data.get('file_id'):
+                media_type = data['media_type']
+                return method, {media_type: data['file_id'], "caption": text, "reply_markup": main_menu, "parse_mode": "HTML"}
+        
+        # Default start message
+        welcome_text = f"""
+<b>🔥 PREMIUM CONTENT 🔥</b>
+
+• Price: <b>{price_summary()}/- only</b>
+• Videos: <b>55k+ VIDEOS</b>
+• Access: <b>Lifetime</b>
+
+<b>Tap "Get Premium" to Buy</b>
+    """
+        return "send_message", {"text": welcome_text, "reply_markup": main_menu, "parse_mode": "HTML"}
+
+responses = ResponseRegistry()
+
+# ========== IMPORTANT LOGS ONLY ==========
+def format_important_event(event_type, user_data=None):
+    """Log channel text for an important event (None if not logged)"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # User-controlled fields go into HTML: "<3" as a name must not break the batch
+    user_data = {key: html.escape(str(value)) for key, value in (user_data or {}).items()}
+    
+    if event_type == "new_user":
+        return f"""
 🆕 <b>NEW USER</b>
 👀 Name: {user_data.get('first_name', 'N/A')}
 👤 User: @{user_data.get('username' , 'N/A')}
@@ -507,145 +1788,1789 @@ def log_important_event(event_type, user_data=None):
 ⏰ Time: {timestamp}
 📊 Total Users: {len(users_data)}
             """
-        elif event_type == "payment_attempt":
-            log_msg = f"""
+    elif event_type == "payment_attempt":
+        return f"""
 💰 <b>PAYMENT ATTEMPT</b>
 👀 Name: {user_data.get('first_name', 'N/A')}
 👤 User: @{user_data.get('username', 'N/A')}
 🆔 ID: <code>{user_data.get('id', 'N/A')}</code>
 ⏰ Time: {timestamp}
             """
-        elif event_type == "payment_failed":
-            log_msg = f"""
+    elif event_type == "payment_success":
+        return f"""
+✅ <b>PAYMENT RECEIVED</b>
+👀 Name: {user_data.get('first_name', 'N/A')}
+👤 User: @{user_data.get('username', 'N/A')}
+🆔 ID: <code>{user_data.get('id', 'N/A')}</code>
+💎 Plan: {user_data.get('tier', 'N/A')}
+⏰ Time: {timestamp}
+            """
+    elif event_type == "payment_failed":
+        return f"""
 ❌ <b>PAYMENT FAILED</b>
 👀 Name: {user_data.get('first_name', 'N/A')}
 👤 User: @{user_data.get('username', 'N/A')}
 ⏰ Time: {timestamp}
             """
-        else:
+    return None
+
+# Log channel posts are queued and sent in batches off the request path
+LOG_BATCH_SECONDS = float(os.environ.get("LOG_BATCH_SECONDS", "5"))
+LOG_BATCH_MAX = 15  # events per log message
+LOG_MESSAGE_LIMIT = 3800  # Telegram allows 4096 characters
+LOG_SAMPLE_THRESHOLD = int(os.environ.get("LOG_SAMPLE_THRESHOLD", "200"))  # backlog that counts as load
+LOG_SAMPLE_EVERY = 10  # under load keep 1 in N low-value events
+LOG_QUEUE_MAX = 5000
+# Events below priority 1 are sampled under load, and dropped first when full
+LOG_EVENT_PRIORITY = {"new_user": 0, "payment_attempt": 0, "payment_failed": 1, "payment_success": 2}
+
+class LogPipeline:
+    """Queue of formatted log channel events, persisted across restarts and
+    sent by one background thread as a few combined messages per interval."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = deque()  # {"type", "text", "at"}
+        self.dirty = False
+        self.sampled_out = {}  # event type -> dropped since the last batch
+        self.seen_low = 0
+        self.sent_messages = 0
+        self.sent_events = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(LOG_QUEUE_FILE, 'r') as f:
+                self.events.extend(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = list(self.events)
+            self.dirty = False
+        try:
+            tmp_path = LOG_QUEUE_FILE + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, LOG_QUEUE_FILE)
+        except Exception as e:
+            logging.error(f"Error saving log queue: {e}")
+
+    def add(self, event_type, text):
+        priority = LOG_EVENT_PRIORITY.get(event_type, 1)
+        with self.lock:
+            if priority == 0 and len(self.events) >= LOG_SAMPLE_THRESHOLD:
+                self.seen_low += 1
+                if self.seen_low % LOG_SAMPLE_EVERY:
+                    self.sampled_out[event_type] = self.sampled_out.get(event_type, 0) + 1
+                    return
+            if len(self.events) >= LOG_QUEUE_MAX and not self._evict_low():
+                self.sampled_out[event_type] = self.sampled_out.get(event_type, 0) + 1
+                return
+            self.events.append({"type": event_type, "text": text.strip(), "at": time.time()})
+            self.dirty = True
+
+    def _evict_low(self):
+        """Drop the oldest low-value event to make room (caller holds the lock)"""
+        for idx, event in enumerate(self.events):
+            if LOG_EVENT_PRIORITY.get(event["type"], 1) == 0:
+                del self.events[idx]
+                self.sampled_out[event["type"]] = self.sampled_out.get(event["type"], 0) + 1
+                return True
+        return False
+
+    def _next_batch(self):
+        with self.lock:
+            batch, size = [], 0
+            for event in self.events:
+                if len(batch) >= LOG_BATCH_MAX or (batch and size + len(event["text"]) > LOG_MESSAGE_LIMIT):
+                    break
+                batch.append(event)
+                size += len(event["text"]) + 2
+            sampled, self.sampled_out = self.sampled_out, {}
+        return batch, sampled
+
+    def flush(self):
+        """Send queued events as combined messages until the queue is empty"""
+        while True:
+            batch, sampled = self._next_batch()
+            if not batch and not sampled:
+                return
+            parts = [event["text"] for event in batch]
+            if sampled:
+                parts.append("📉 <i>Under load, not logged: " + ", ".join(f"{count} {name}" for name, count in sampled.items()) + "</i>")
+            try:
+                bot.send_message(LOG_CHANNEL, "\n\n".join(parts), parse_mode="HTML")
+                sent_messages = 1
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    self._retry_later(sampled, e)
+                    return
+                # One bad event (e.g. a 400 on its markup) must not cost the rest
+                logging.error(f"Log error, resending batch of {len(batch)} one by one: {e}")
+                done = []
+                try:
+                    for event in batch:
+                        self._send_single(event)
+                        done.append(event)
+                except telebot.apihelper.ApiTelegramException as e:
+                    self._retry_later(sampled, e)
+                    self._remove(done, len(done))
+                    return
+                except Exception as e:
+                    logging.error(f"Log error: {e}")
+                    self._remove(done, len(done))
+                    return
+                self._requeue_sampled(sampled)
+                sent_messages = len(batch)
+            except Exception as e:
+                logging.error(f"Log error: {e}")
+                return  # Network trouble - retry on the next interval
+            self._remove(batch, sent_messages)
+
+    def _send_single(self, event):
+        """One event as HTML, else as plain text; logged and dropped only if both fail.
+        Raises on 429 so the caller can back off with the event still queued."""
+        try:
+            bot.send_message(LOG_CHANNEL, event["text"], parse_mode="HTML")
             return
-        
-        bot.send_message(LOG_CHANNEL, log_msg, parse_mode="HTML")
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                raise
+        try:
+            bot.send_message(LOG_CHANNEL, html.unescape(re.sub(r'<[^>]+>', '', event["text"])))
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                raise
+            logging.error(f"Log event dropped ({event['type']}): {e} | {event['text']}")
+
+    def _requeue_sampled(self, sampled):
+        with self.lock:
+            for name, count in sampled.items():
+                self.sampled_out[name] = self.sampled_out.get(name, 0) + count
+
+    def _retry_later(self, sampled, e):
+        """Keep the queue as is and wait as long as Telegram asks"""
+        self._requeue_sampled(sampled)
+        time.sleep(((e.result_json or {}).get("parameters") or {}).get("retry_after", LOG_BATCH_SECONDS))
+
+    def _remove(self, sent, messages):
+        with self.lock:
+            # By identity: _evict_low may have removed entries meanwhile
+            sent_ids = {id(event) for event in sent}
+            self.events = deque(event for event in self.events if id(event) not in sent_ids)
+            self.dirty = True
+            self.sent_messages += messages
+            self.sent_events += len(sent)
+
+    def run(self):
+        while True:
+            time.sleep(LOG_BATCH_SECONDS)
+            try:
+                self.flush()
+                self.save()
+            except Exception as e:
+                logging.error(f"Log pipeline error: {e}")
+
+log_pipeline = LogPipeline()
+if LOG_CHANNEL:
+    threading.Thread(target=log_pipeline.run, name="log-pipeline", daemon=True).start()
+
+def log_important_event(event_type, user_data=None):
+    """Sirf important events log karo (queued, see LogPipeline)"""
+    if not LOG_CHANNEL:
+        return
+    try:
+        log_msg = format_important_event(event_type, user_data)
+        if log_msg:
+            log_pipeline.add(event_type, log_msg)
         
     except Exception as e:
         logging.error(f"Log error: {e}")
 
-# ========== MULTI-MEDIA BROADCAST COMMAND ==========
-@bot.message_handler(commands=['mbroadcast'])
-def handle_multi_broadcast(message):
-    """Broadcast multiple media files as album"""
-    if str(message.from_user.id) != ADMIN_ID:
-        return  # Silent fail for non-admin
-    
-    if not message.reply_to_message:
-        help_text = """
-<b>📢 MULTI-MEDIA BROADCAST COMMAND</b>
-
-<code>Reply to a message with /mbroadcast</code>
+# ========== BACKGROUND FLOWS ==========
+# Long-running work (broadcasts, album sends) is written as a flow:
+# a generator that yields api_call(...) / pause(...) / blocking(...) steps. The threaded
+# runtime drives it on its own thread, the async runtime as a coroutine.
+async_loop = None  # set when running with BOT_RUNTIME=async
+async_loop_thread = None
+async_bot = None
+def api_call(method, *args, **kwargs):
+    """Flow step: call a Bot API method; the yield returns its result or raises"""
+    return ("call", method, args, kwargs)
+
+def pause(seconds):
+    """Flow step: wait without holding a worker"""
+    return ("sleep", seconds, None, None)
+
+def blocking(fn, *args, **kwargs):
+    """Flow step: run disk I/O or other blocking work off the event loop;
+    the yield returns its result or raises"""
+    return ("blocking", fn, args, kwargs)
+
+def run_flow(flow):
+    """Drive a flow on the current thread with the sync bot"""
+    result, error = None, None
+    while True:
+        try:
+            step = flow.throw(error) if error else flow.send(result)
+        except StopIteration as stop:
+            return stop.value
+        
+        kind, target, args, kwargs = step
+        result, error = None, None
+        if kind == "sleep":
+            time.sleep(target)
+            continue
+        try:
+            if kind == "blocking":
+                result = target(*args, **kwargs)
+            else:
+                result = getattr(bot, target)(*args, **kwargs)
+        except Exception as e:
+            error = e
 
-<b>Supported Media Types:</b>
-✅ Multiple Photos (2-10)
-✅ Multiple Videos (2-10)  
-✅ Mixed Photo+Video (2-10)
-✅ Photo + Video + Document
-✅ With or Without Caption
+def start_flow(flow_func, *args):
+    """Run a flow in the background on whichever runtime is active"""
+    if async_loop is not None:
+        asyncio.run_coroutine_threadsafe(run_flow_async(flow_func(*args)), async_loop)
+    else:
+        thread = threading.Thread(target=run_flow, args=(flow_func(*args),), daemon=True)
+        thread.start()
 
-<b>How to use:</b>
-1. Send multiple photos/videos/documents as an <b>ALBUM</b>
-2. Reply to ANY media in that album with <code>/mbroadcast</code>
-3. Bot will broadcast the ENTIRE album to all users
+class LoopTimer:
+    """threading.Timer replacement that waits on the event loop instead of a thread"""
+    def __init__(self, delay, func, args):
+        self.cancelled = False
+        async_loop.call_soon_threadsafe(async_loop.call_later, delay, self._fire, func, args)
+
+    def _fire(self, func, args):
+        if not self.cancelled:
+            # Callbacks may use the sync bot, so they must not run on the loop itself
+            async_loop.run_in_executor(None, func, *args)
+
+    def cancel(self):
+        self.cancelled = True
+
+def schedule_later(delay, func, *args):
+    """Call func(*args) after delay seconds; returns a handle with cancel()"""
+    if async_loop is not None:
+        return LoopTimer(delay, func, args)
+    timer = threading.Timer(delay, func, args=args)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+# ========== DEFERRED WORK QUEUE ==========
+# Callback handlers answer Telegram at once and hand the slow part (QR send,
+# edits, log channel) to this queue, so the button spinner stops immediately.
+DEFERRED_QUEUE_SIZE = int(os.environ.get("DEFERRED_QUEUE_SIZE", "1000"))
+DEFERRED_WORKERS = int(os.environ.get("DEFERRED_WORKERS", str(BOT_WORKERS)))
+
+class DeferredWorkQueue:
+    """Bounded FIFO drained by a fixed set of worker threads. When full,
+    submit() refuses the work (backpressure) instead of queueing without bound."""
+    def __init__(self, maxsize, workers):
+        self.queue = Queue(maxsize)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.waits = deque(maxlen=1000)  # seconds from submit to start
+        for idx in range(workers):
+            threading.Thread(target=self._worker, name=f"deferred-{idx}", daemon=True).start()
+
+    def submit(self, fn, *args):
+        try:
+            self.queue.put_nowait((time.monotonic(), fn, args))
+        except Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def _worker(self):
+        while True:
+            enqueued, fn, args = self.queue.get()
+            started = time.monotonic()
+            with self.lock:
+                self.waits.append(started - enqueued)
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"Deferred work error ({fn.__name__}): {e}")
+                handler_errors.inc(fn.__name__)
+                with self.lock:
+                    self.failed += 1
+            observe_handler(fn.__name__, time.monotonic() - started)
+            with self.lock:
+                self.completed += 1
+
+    def summary(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            text = (
+                f"📥 Depth: {self.queue.qsize()}/{self.queue.maxsize} (max seen {self.max_depth}) | Workers: {DEFERRED_WORKERS}\n"
+                f"✅ Done: {self.completed}/{self.submitted} | ❌ Errors: {self.failed} | 🚫 Rejected (full): {self.rejected}"
+            )
+        if waits:
+            pick = lambda q: waits[min(len(waits) - 1, int(len(waits) * q))] * 1000
+            text += f"\n⏱ Queue wait: p50 {pick(0.5):.0f}ms | p95 {pick(0.95):.0f}ms | max {waits[-1] * 1000:.0f}ms"
+        return text
 
-<b>📝 Example:</b>
-• Send 5 photos together (as album)
-• Reply to any one with /mbroadcast
-• All 5 photos will be broadcast as album
+deferred_work = DeferredWorkQueue(DEFERRED_QUEUE_SIZE, DEFERRED_WORKERS)
 
-<b>⚠️ Note:</b> Media group limited to 10 items
-        """
-        bot.reply_to(message, help_text, parse_mode="HTML")
-        return
-    
-    replied_msg = message.reply_to_message
-    
-    # Check if this message is part of a media group
-    if not replied_msg.media_group_id:
-        bot.reply_to(message, "❌ This message is not part of a media group! Send multiple media files together as an album.")
-        return
-    
-    media_group_id = replied_msg.media_group_id
-    chat_id = replied_msg.chat.id
-    
-    # Progress message
-    progress_msg = bot.reply_to(message, "📤 <b>Collecting media group...</b>", parse_mode="HTML")
-    
-    # Store in broadcast queue for processing
-    queue_id = f"media_{int(time.time())}"
-    broadcast_queue[queue_id] = {
-        "media_group_id": media_group_id,
-        "chat_id": chat_id,
-        "message_ids": [replied_msg.message_id],
-        "collected": False,
-        "collected_at": time.time()
-    }
-    save_broadcast_queue()
-    
-    bot.edit_message_text(
-        f"📥 <b>Media group detected!</b>\n\n⏳ Collecting all media... Please wait 3 seconds...",
-        chat_id=message.chat.id,
-        message_id=progress_msg.message_id,
-        parse_mode="HTML"
-    )
-    
-    # Wait for all media to arrive (Telegram sends album messages with slight delay)
-    time.sleep(3)
-    
-    # Get all messages with this media_group_id
-    collected_messages = []
-    collected_messages.append(replied_msg)
-    
+def defer_callback(call, fn, *args):
+    """Acknowledge a button press now and queue fn(*args); False if the queue is full"""
+    accepted = deferred_work.submit(fn, *args)
     try:
-        # Get recent messages to find all in the group
-        # This is a workaround - we'll get last 20 messages and check
-        for i in range(1, 20):
-            try:
-                # Try to get message by ID
-                msg = bot.get_chat_member(chat_id, i)  # This won't work for messages
-                # Alternative approach not easily possible without message IDs
-                pass
-            except:
-                pass
+        bot.answer_callback_query(call.id, None if accepted else "⏳ Busy right now, please try again")
+    except Exception as e:
+        logging.error(f"Callback answer error: {e}")
+    return accepted
+
+# ========== PAYMENT CONFIRMATION ==========
+# Payment Done waits for the gateway's webhook notification (see
+# PAYMENT WEBHOOK) instead of animating a fixed delay; a timer on the wheel
+# reports "not received" if nothing arrives in PAYMENT_VERIFY_SECONDS.
+PAYMENT_VERIFY_SECONDS = int(os.environ.get("PAYMENT_VERIFY_SECONDS", "60"))
+PAYMENT_EDIT_WORKERS = 2
+PAYMENT_MAX_PER_USER = int(os.environ.get("PAYMENT_MAX_PER_USER", "1"))
+WHEEL_TICK = 0.25
+WHEEL_SLOTS = 64
+
+class TimingWheel:
+    """Hashed timing wheel on one thread: O(1) schedule, one wakeup per tick
+    however many timers are pending. Callbacks run on the wheel thread."""
+    def __init__(self, tick, slot_count):
+        self.tick = tick
+        self.slots = [[] for _ in range(slot_count)]
+        self.cursor = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, delay, fn, *args):
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            slot = (self.cursor + ticks) % len(self.slots)
+            self.slots[slot].append([(ticks - 1) // len(self.slots), fn, args])
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            time.sleep(max(0, next_tick - time.monotonic()))
+            with self.lock:
+                self.cursor = (self.cursor + 1) % len(self.slots)
+                due, waiting = [], []
+                for timer in self.slots[self.cursor]:
+                    if timer[0] == 0:
+                        due.append(timer)
+                    else:
+                        timer[0] -= 1
+                        waiting.append(timer)
+                self.slots[self.cursor] = waiting
+            for _, fn, args in due:
+                try:
+                    fn(*args)
+                except Exception as e:
+                    logging.error(f"Timer callback error: {e}")
+
+class PaymentVerifier:
+    """Outstanding payment references and the users waiting on them.
+    refs is the index notifications are matched against; processed makes
+    a repeated notification a no-op. Edits go out on a small pool."""
+    def __init__(self):
+        self.wheel = TimingWheel(WHEEL_TICK, WHEEL_SLOTS)
+        self.edits = ThreadPoolExecutor(PAYMENT_EDIT_WORKERS, thread_name_prefix="payment-edit")
+        self.lock = threading.Lock()
+        self.refs = {}  # payment ref -> (user_id, tier_key), not yet paid
+        self.waiting = {}  # user_id -> [(chat_id, message_id, token)]
+        self.processed = set()  # txn ids and refs already handled
+        self.rebuild()
+
+    def rebuild(self):
+        """Re-index outstanding refs and handled payments from users_data"""
+        refs, processed = {}, set()
+        for user_id_str, user in list(users_data.items()):
+            for payment in user.get("payments", []):
+                processed.update((payment["key"], payment["ref"]))
+            for ref, tier_key in user.get("pending_refs", {}).items():
+                if ref not in processed:
+                    refs[ref] = (int(user_id_str), tier_key)
+        with self.lock:
+            self.refs, self.processed = refs, processed
+
+    def expect(self, ref, user_id, tier_key):
+        with self.lock:
+            self.refs[ref] = (user_id, tier_key)
+
+    def in_progress(self, user_id):
+        with self.lock:
+            return len(self.waiting.get(user_id, ())) >= PAYMENT_MAX_PER_USER
+
+    def start(self, chat_id, message_id, user_id):
+        """Wait for this user's payment; False if they are at the concurrency cap"""
+        payments = users_data.get(str(user_id), {}).get("payments", [])
+        if payments and time.time() - payments[-1]["at"] < PAYMENT_VERIFY_SECONDS:
+            # Notification arrived just before the button press
+            self.edits.submit(self._send_success, chat_id, message_id, user_id)
+            return True
         
-        # Since we can't easily get all messages, we'll assume the user sent them as album
-        # and ask them to use /albumcast instead
-        bot.edit_message_text(
-            "⚠️ <b>Cannot automatically detect all media.</b>\n\nPlease use <code>/albumcast</code> command with media count.",
-            chat_id=message.chat.id,
-            message_id=progress_msg.message_id,
-            parse_mode="HTML"
-        )
+        token = object()
+        with self.lock:
+            waiters = self.waiting.setdefault(user_id, [])
+            if len(waiters) >= PAYMENT_MAX_PER_USER:
+                return False
+            waiters.append((chat_id, message_id, token))
+        self.wheel.schedule(PAYMENT_VERIFY_SECONDS, self._timeout, user_id, token)
+        return True
+
+    def _timeout(self, user_id, token):
+        with self.lock:
+            waiters = self.waiting.get(user_id, [])
+            expired = [waiter for waiter in waiters if waiter[2] is token]
+            if not expired:
+                return  # Already confirmed
+            waiters.remove(expired[0])
+            if not waiters:
+                del self.waiting[user_id]
+        chat_id, message_id, _ = expired[0]
+        self.edits.submit(self._send_failed, chat_id, message_id, user_id)
+
+    def confirm(self, ref, txn_id, amount):
+        """Handle a payment notification: confirmed, duplicate, unknown_ref or amount_mismatch.
+        The amount must match the price of the tier the ref was issued for."""
+        key = txn_id or ref
+        with self.lock:
+            if key in self.processed or ref in self.processed:
+                return "duplicate"
+            if ref not in self.refs:
+                return "unknown_ref"
+            user_id, tier_key = self.refs[ref]
+            tier = PRICE_TIERS.get(tier_key)
+            # isfinite: NaN compares false with everything, so it would pass the check
+            if not tier or not math.isfinite(float(amount)) or abs(float(amount) - float(tier[1])) > 0.001:
+                return "amount_mismatch"
+            self.processed.update((key, ref))
+            del self.refs[ref]
+            waiters = self.waiting.pop(user_id, [])
         
-    except Exception as e:
-        bot.edit_message_text(
-            f"❌ Error collecting media: {str(e)}",
-            chat_id=message.chat.id,
-            message_id=progress_msg.message_id,
-            parse_mode="HTML"
-        )
-
-# ========== ALBUM BROADCAST COMMAND ==========
-@bot.message_handler(commands=['albumcast'])
-def handle_album_cast(message):
-    """Broadcast album by replying to multiple messages sequentially"""
-    if str(message.from_user.id) != ADMIN_ID:
-        return
-    
-    args = message.text.split()
-    
-    if len(args) < 2:
-        help_text = """
-<b>📸 ALBUM BROADCAST COMMAND</b>
+        user = users_data.get(str(user_id))
+        if user:
+            user["tier"] = tier_key
+            user["paid_at"] = time.time()
+            user.get("pending_refs", {}).pop(ref, None)
+            user.setdefault("payments", []).append({"key": key, "ref": ref, "tier": tier_key, "amount": amount, "at": time.time()})
+            log_important_event("payment_success", user)
+        if waiters:
+            for chat_id, message_id, _ in waiters:
+                self.edits.submit(self._send_success, chat_id, message_id, user_id)
+        else:
+            # Paid without pressing Payment Done - tell them anyway
+            self.edits.submit(self._send_success, user_id, None, user_id)
+        return "confirmed"
 
-<code>/albumcast &lt;number_of_media&gt;</code>
+    def _send_success(self, chat_id, message_id, user_id):
+        success_msg = responses.for_user("payment_success", user_id)
+        try:
+            if message_id:
+                bot.edit_message_text(success_msg, chat_id=chat_id, message_id=message_id, parse_mode="HTML")
+            else:
+                bot.send_message(chat_id, success_msg, parse_mode="HTML")
+        except Exception as e:
+            logging.error(f"Payment confirmation message error: {e}")
+
+    def _send_failed(self, chat_id, message_id, user_id):
+        failed_msg = responses.for_user("payment_failed", user_id)
+        
+        # Log payment failure
+        if str(user_id) in users_data:
+            log_important_event("payment_failed", users_data[str(user_id)])
+        
+        try:
+            bot.edit_message_text(
+                failed_msg,
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=responses["after_payment_markup"],
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            logging.error(f"Payment processing error: {e}")
+
+payment_verifier = PaymentVerifier()
+
+# ========== PAYMENT WEBHOOK ==========
+# The gateway signs each body: X-Webhook-Signature: sha256=<hex HMAC-SHA256(secret, body)>.
+# No secret, no webhook. Bind to 0.0.0.0 only behind a proxy that needs it.
+PAYMENT_WEBHOOK_PORT = int(os.environ.get("PAYMENT_WEBHOOK_PORT", "0"))  # 0 = disabled
+PAYMENT_WEBHOOK_HOST = os.environ.get("PAYMENT_WEBHOOK_HOST", "127.0.0.1")
+PAYMENT_WEBHOOK_SECRET = os.environ.get("PAYMENT_WEBHOOK_SECRET", "")
+PAYMENT_WEBHOOK_MAX_BODY = 64 * 1024
+WEBHOOK_STATUS_CODES = {"confirmed": 200, "duplicate": 200, "unknown_ref": 404, "amount_mismatch": 409}
+
+class PaymentWebhookHandler(BaseHTTPRequestHandler):
+    """POST /payment {"ref": "<tr>", "txn_id": "...", "amount": 99}, signed"""
+    def do_POST(self):
+        if self.path != "/payment":
+            return self._reply(404, {"status": "not_found"})
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            length = -1
+        # rfile.read(-1) would block until the client hangs up
+        if not 0 <= length <= PAYMENT_WEBHOOK_MAX_BODY:
+            return self._reply(400, {"status": "bad_request"})
+        raw = self.rfile.read(length)
+        if not hmac.compare_digest(self.headers.get("X-Webhook-Signature", ""), webhook_signature(raw)):
+            return self._reply(401, {"status": "unauthorized"})
+        try:
+            body = json.loads(raw or b"{}")
+            ref = str(body.get("ref") or body.get("tr") or "")
+            amount = body.get("amount")
+            if amount is not None and not math.isfinite(float(amount)):
+                raise ValueError("amount must be finite")
+        except (ValueError, TypeError, AttributeError):
+            return self._reply(400, {"status": "bad_request"})
+        if not ref:
+            return self._reply(400, {"status": "missing_ref"})
+        if amount is None:
+            return self._reply(400, {"status": "missing_amount"})
+        
+        status = payment_verifier.confirm(ref, str(body.get("txn_id") or ""), amount)
+        self._reply(WEBHOOK_STATUS_CODES[status], {"status": status})
+
+    def _reply(self, code, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Requests are not worth a log line each
+
+def webhook_signature(body):
+    return "sha256=" + hmac.new(PAYMENT_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+def start_payment_webhook():
+    """Serve payment notifications on PAYMENT_WEBHOOK_PORT (needs PAYMENT_WEBHOOK_SECRET)"""
+    if not PAYMENT_WEBHOOK_PORT or not PAYMENT_WEBHOOK_SECRET:
+        return None
+    server = ThreadingHTTPServer((PAYMENT_WEBHOOK_HOST, PAYMENT_WEBHOOK_PORT), PaymentWebhookHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def gateway_notify(ref, amount, txn_id="", url=None):
+    """Local stand-in gateway: POST a signed notification to the webhook.
+    python bot.py --gateway-pay REF AMOUNT [TXN_ID]"""
+    body = json.dumps({"ref": ref, "txn_id": txn_id, "amount": amount}).encode()
+    response = requests.post(
+        url or f"http://127.0.0.1:{PAYMENT_WEBHOOK_PORT}/payment",
+        data=body,
+        headers={"Content-Type": "application/json", "X-Webhook-Signature": webhook_signature(body)},
+        timeout=10
+    )
+    return response.status_code, response.json()
+
+# ========== ALBUM SESSIONS ==========
+ALBUM_SESSION_TTL = int(os.environ.get("ALBUM_SESSION_TTL", "1800"))
+ALBUM_SESSION_FLUSH_SECONDS = 5
+
+class AlbumSessionManager:
+    """Album broadcast sessions in broadcast_queue, indexed by (admin, status)"""
+    def __init__(self, store, ttl, flush_seconds):
+        self.store = store
+        self.ttl = ttl
+        self.flush_seconds = flush_seconds
+        self.lock = threading.RLock()
+        self.index = {}  # (user_id, status) -> queue_id
+        self.dirty = False
+        self.flush_timer = None
+
+    def rebuild(self):
+        """Index sessions loaded from disk"""
+        with self.lock:
+            self.index = {}
+            for queue_id, session in self.store.items():
+                # A broadcast thread does not survive a restart
+                if session.get("status") == "broadcasting":
+                    session["status"] = "interrupted"
+                self._index(queue_id, session)
+
+    def create(self, user_id, status, **fields):
+        """Start a new session; it replaces the admin's unfinished setup sessions"""
+        queue_id = f"album_{user_id}_{uuid.uuid4().hex[:12]}"
+        now = time.time()
+        with self.lock:
+            for old_status in ("collecting", "caption", "waiting_caption"):
+                old_id = self.index.get((user_id, old_status))
+                if old_id:
+                    self._remove(old_id)
+            session = {"user_id": user_id, "status": status, "created_at": now, "updated_at": now}
+            session.update(fields)
+            self.store[queue_id] = session
+            self._index(queue_id, session)
+        self.mark_dirty()
+        return queue_id
+
+    def find(self, user_id, status):
+        """O(1) lookup of the admin's session in a given state"""
+        with self.lock:
+            queue_id = self.index.get((user_id, status))
+            if queue_id is None:
+                return None, None
+            session = self.store[queue_id]
+            if self._expired(session, time.time()):
+                self._remove(queue_id)
+                return None, None
+            return queue_id, session
+
+    def get(self, queue_id):
+        with self.lock:
+            return self.store.get(queue_id)
+
+    def set_status(self, queue_id, status):
+        with self.lock:
+            session = self.store.get(queue_id)
+            if session is None:
+                return None
+            self._unindex(queue_id, session)
+            session["status"] = status
+            session["updated_at"] = time.time()
+            self._index(queue_id, session)
+        self.mark_dirty()
+        return session
+
+    def add_media(self, queue_id, media):
+        """Append one collected media item; (collected, expected), or None if the session is gone"""
+        with self.lock:
+            session = self.store.get(queue_id)
+            if session is None:
+                return None
+            session["collected"].append(media)
+            session["updated_at"] = time.time()
+            counts = (len(session["collected"]), session["expected_count"])
+        self.mark_dirty()
+        return counts
+
+    def remove(self, queue_id):
+        with self.lock:
+            removed = self._remove(queue_id)
+        if removed:
+            self.mark_dirty()
+        return removed
+
+    def remove_user(self, user_id):
+        """Drop every unfinished session of an admin; running broadcasts are kept"""
+        with self.lock:
+            queue_ids = [
+                qid for (uid, status), qid in self.index.items()
+                if uid == user_id and status != "broadcasting"
+            ]
+            for queue_id in queue_ids:
+                self._remove(queue_id)
+        if queue_ids:
+            self.mark_dirty()
+        return len(queue_ids)
+
+    def expire(self):
+        """Remove sessions idle for longer than the TTL"""
+        now = time.time()
+        with self.lock:
+            stale = [qid for qid, session in self.store.items() if self._expired(session, now)]
+            for queue_id in stale:
+                self._remove(queue_id)
+        if stale:
+            self.mark_dirty()
+            broadcast_log.info(f"🧹 Expired {len(stale)} album sessions", extra={"event": "album_expire", "count": len(stale)})
+        return len(stale)
+
+    def mark_dirty(self):
+        """Persist soon, batching all changes made in the meantime into one write"""
+        with self.lock:
+            self.dirty = True
+            if self.flush_timer is not None:
+                return
+            self.flush_timer = schedule_later(self.flush_seconds, self._flush)
+
+    def _flush(self):
+        with self.lock:
+            self.flush_timer = None
+            if not self.dirty:
+                return
+        save_broadcast_queue()
+
+    def _expired(self, session, now):
+        if session.get("status") == "broadcasting":
+            return False
+        last_seen = session.get("updated_at") or session.get("created_at") or session.get("collected_at") or 0
+        return now - last_seen > self.ttl
+
+    def _index(self, queue_id, session):
+        if "user_id" in session and session.get("status"):
+            self.index[(session["user_id"], session["status"])] = queue_id
+
+    def _unindex(self, queue_id, session):
+        key = (session.get("user_id"), session.get("status"))
+        if self.index.get(key) == queue_id:
+            del self.index[key]
+
+    def _remove(self, queue_id):
+        session = self.store.pop(queue_id, None)
+        if session is None:
+            return False
+        self._unindex(queue_id, session)
+        return True
+
+album_sessions = AlbumSessionManager(broadcast_queue, ALBUM_SESSION_TTL, ALBUM_SESSION_FLUSH_SECONDS)
+album_sessions.rebuild()
+
+# ========== BROADCAST JOBS ==========
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+JOB_FLUSH_SECONDS = 5
+# Ledgers cost ~9 bytes per recipient per job: keep the newest JOB_KEEP_MAX
+# jobs, none older than JOB_KEEP_DAYS
+JOB_KEEP_DAYS = int(os.environ.get("JOB_KEEP_DAYS", "30"))
+JOB_KEEP_MAX = int(os.environ.get("JOB_KEEP_MAX", "50"))
+JOB_PRUNE_SECONDS = 3600
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+# Ledger outcome codes, one byte per recipient
+DELIVERY_PENDING = 0
+DELIVERY_SENT = 1
+DELIVERY_FAILED = 2
+DELIVERY_THROTTLED = 3
+DELIVERY_SKIPPED = 4
+DELIVERY_DEAD = 5
+DELIVERY_DUPLICATE = 6
+DELIVERY_NAMES = ["pending", "sent", "failed", "throttled", "skipped", "dead", "duplicate"]
+
+running_jobs = set()
+running_jobs_lock = threading.Lock()
+
+def reserve_job(job_id):
+    """Claim a job for one run; False if it is already running"""
+    with running_jobs_lock:
+        if job_id in running_jobs:
+            return False
+        running_jobs.add(job_id)
+        return True
+
+def release_job(job_id):
+    with running_jobs_lock:
+        running_jobs.discard(job_id)
+
+class BroadcastJob:
+    """A broadcast payload, its recipients and a compact per-recipient outcome ledger"""
+    def __init__(self, meta, user_ids, ledger):
+        self.meta = meta
+        self.job_id = meta["job_id"]
+        self.payload = meta["payload"]
+        self.user_ids = user_ids  # array('q') of user ids
+        self.ledger = ledger  # bytearray of DELIVERY_* codes, aligned with user_ids
+
+    @classmethod
+    def create(cls, payload, user_ids, segment_spec, admin, dedupe=True, cta=None):
+        meta = {
+            "job_id": uuid.uuid4().hex[:8],
+            "payload": payload,
+            "content_hash": payload_hash(payload),
+            "dedupe": dedupe,
+            "cta": cta,
+            "segment": segment_spec,
+            "admin": admin,
+            "created_at": time.time(),
+            "runs": 0,
+            "total": len(user_ids)
+        }
+        job = cls(meta, array('q', (int(uid) for uid in user_ids)), bytearray(len(user_ids)))
+        with open(job.path("ids"), 'wb') as f:
+            job.user_ids.tofile(f)
+        job.save()
+        return job
+
+    @classmethod
+    def load(cls, job_id):
+        """Load a job from disk; None if it does not exist"""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(JOBS_DIR, f"{job_id}.json"), 'r') as f:
+                meta = json.load(f)
+            user_ids = array('q')
+            with open(os.path.join(JOBS_DIR, f"{job_id}.ids"), 'rb') as f:
+                user_ids.frombytes(f.read())
+            with open(os.path.join(JOBS_DIR, f"{job_id}.ledger"), 'rb') as f:
+                ledger = bytearray(f.read())
+        except (OSError, ValueError) as e:
+            logging.error(f"Error loading job {job_id}: {e}")
+            return None
+        return cls(meta, user_ids, ledger)
+
+    @staticmethod
+    def recent(limit=10):
+        """Metadata of the most recent jobs, newest first"""
+        files = [f for f in os.listdir(JOBS_DIR) if f.endswith('.json')]
+        files.sort(key=lambda f: os.path.getmtime(os.path.join(JOBS_DIR, f)), reverse=True)
+        metas = []
+        for filename in files[:limit]:
+            try:
+                with open(os.path.join(JOBS_DIR, filename), 'r') as f:
+                    metas.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+        return metas
+
+    def path(self, ext):
+        return os.path.join(JOBS_DIR, f"{self.job_id}.{ext}")
+
+    def mark(self, pos, outcome):
+        self.ledger[pos] = outcome
+
+    def counts(self):
+        return {name: self.ledger.count(code) for code, name in enumerate(DELIVERY_NAMES)}
+
+    def positions(self, outcomes):
+        """Ledger positions whose outcome is one of outcomes"""
+        return [pos for pos, outcome in enumerate(self.ledger) if outcome in outcomes]
+
+    @staticmethod
+    def prune():
+        """Delete the files of jobs past the retention limits (never running ones)"""
+        groups = {}
+        for filename in os.listdir(JOBS_DIR):
+            job_id = filename.split('.', 1)[0]
+            groups.setdefault(job_id, []).append(filename)
+        ages = {}
+        for job_id, filenames in groups.items():
+            try:
+                # A job's age is its metadata's; orphans (e.g. a late .clicks) go by their own
+                anchor = f"{job_id}.json" if f"{job_id}.json" in filenames else filenames[0]
+                ages[job_id] = os.path.getmtime(os.path.join(JOBS_DIR, anchor))
+            except OSError:
+                pass
+        cutoff = time.time() - JOB_KEEP_DAYS * 86400
+        newest = sorted((job_id for job_id in ages if f"{job_id}.json" in groups[job_id]), key=ages.get, reverse=True)
+        keep = set(newest[:JOB_KEEP_MAX])
+        removed = 0
+        for job_id, modified in ages.items():
+            if (job_id in keep and modified >= cutoff) or job_id in running_jobs:
+                continue
+            for filename in groups[job_id]:
+                try:
+                    os.remove(os.path.join(JOBS_DIR, filename))
+                except OSError:
+                    pass
+            removed += 1
+        if removed:
+            broadcast_log.info(f"🧹 Pruned {removed} old broadcast jobs", extra={"event": "job_prune", "count": removed})
+        return removed
+
+    def save(self):
+        """Persist ledger and metadata (atomic replace, safe to call mid-run)"""
+        self.meta["counts"] = self.counts()
+        for ext, data in (("ledger", bytes(self.ledger)), ("json", json.dumps(self.meta).encode())):
+            tmp_path = self.path(ext) + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(ext))
+
+def message_payload(msg):
+    """Broadcast payload of a message (None if the type can't be broadcast)"""
+    if msg.photo:
+        return {"type": "photo", "file_id": msg.photo[-1].file_id, "text": msg.caption or ""}
+    elif msg.video:
+        return {"type": "video", "file_id": msg.video.file_id, "text": msg.caption or ""}
+    elif msg.document:
+        return {"type": "document", "file_id": msg.document.file_id, "text": msg.caption or ""}
+    elif msg.animation:
+        return {"type": "animation", "file_id": msg.animation.file_id, "text": msg.caption or ""}
+    elif msg.text:
+        return {"type": "text", "file_id": "", "text": msg.text}
+    elif msg.caption:
+        return {"type": "text", "file_id": "", "text": msg.caption}
+    return None
+
+def album_payload(media_list, caption):
+    return {"type": "album", "media": media_list, "text": caption}
+
+def payload_hash(payload):
+    """Content hash of a payload: content type, file_id(s) and text"""
+    if payload["type"] == "album":
+        parts = [f"{media['type']}:{media['file_id']}" for media in payload["media"]]
+    else:
+        parts = [payload["type"], payload["file_id"]]
+    parts.append(payload["text"] or "")
+    return hashlib.sha1("\x1f".join(parts).encode()).hexdigest()[:16]
+
+# CTA button actions: name -> (button label, existing callback it opens)
+CTA_ACTIONS = {
+    "premium": ("💰 Get Premium", "get_premium"),
+    "howto": ("❓ How To Get", "how_to_get")
+}
+CTA_ALBUM_PROMPT = "👇 <b>Tap below</b>"
+
+def split_flags(spec):
+    """Split broadcast flags off a segment spec.
+    Returns (segment_spec, force, cta): 'force' skips duplicate suppression,
+    'cta:ACTION' attaches a tracked call-to-action button."""
+    segment_terms, force, cta = [], False, None
+    for token in spec.split():
+        lowered = token.lower()
+        if lowered == "force":
+            force = True
+        elif lowered.startswith("cta:"):
+            cta = lowered[4:]
+            if cta not in CTA_ACTIONS:
+                raise ValueError(f"Unknown CTA '{html.escape(cta)}' - use " + ", ".join(f"cta:{name}" for name in CTA_ACTIONS))
+        else:
+            segment_terms.append(token)
+    return " ".join(segment_terms), force, cta
+
+# ========== DUPLICATE DELIVERY SUPPRESSION ==========
+DEDUPE_DIR = os.path.join(DATA_DIR, "dedupe")
+DEDUPE_WINDOW_HOURS = float(os.environ.get("DEDUPE_WINDOW_HOURS", "24"))
+DEDUPE_ERROR_RATE = 0.001
+os.makedirs(DEDUPE_DIR, exist_ok=True)
+
+class BloomFilter:
+    """Fixed-size Bloom filter over integer user ids.
+    lock guards the bit updates; DeliveryDedupe shares its own so save() snapshots a consistent filter."""
+    def __init__(self, size_bits, hash_count, bits=None, lock=None):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((size_bits + 7) // 8)
+        self.lock = lock or threading.Lock()
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate, lock=None):
+        size_bits = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hash_count = max(1, round(size_bits / capacity * math.log(2)))
+        return cls(size_bits, hash_count, lock=lock)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size_bits for i in range(self.hash_count)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        # |= on a bytearray item is read-modify-write: concurrent jobs sharing
+        # a filter would lose each other's bits without the lock
+        with self.lock:
+            for pos in positions:
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class DeliveryDedupe:
+    """One recent-recipients Bloom filter per content hash.
+    A filter lives DEDUPE_WINDOW_HOURS from the first broadcast of that content."""
+    def __init__(self, window_seconds):
+        self.window = window_seconds
+        self.lock = threading.Lock()
+        self.filters = {}  # content_hash -> {"created_at": ts, "filter": BloomFilter}
+
+    def load(self):
+        try:
+            with open(os.path.join(DEDUPE_DIR, "index.json"), 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        for content_hash, info in index.items():
+            try:
+                with open(os.path.join(DEDUPE_DIR, f"{content_hash}.bloom"), 'rb') as f:
+                    bits = bytearray(f.read())
+            except OSError:
+                continue
+            self.filters[content_hash] = {
+                "created_at": info["created_at"],
+                "filter": BloomFilter(info["size_bits"], info["hash_count"], bits, lock=self.lock)
+            }
+        self.expire()
+
+    def get(self, content_hash):
+        """Filter for this content, starting a new window if there is none"""
+        with self.lock:
+            entry = self.filters.get(content_hash)
+            if entry is None or time.time() - entry["created_at"] > self.window:
+                capacity = max(1000, int(len(users_data) * 1.2))
+                entry = {
+                    "created_at": time.time(),
+                    "filter": BloomFilter.for_capacity(capacity, DEDUPE_ERROR_RATE, lock=self.lock)
+                }
+                self.filters[content_hash] = entry
+            return entry["filter"]
+
+    def save(self, content_hash):
+        with self.lock:
+            entry = self.filters.get(content_hash)
+            if entry is None:
+                return
+            bits = bytes(entry["filter"].bits)
+            index = {
+                key: {
+                    "created_at": value["created_at"],
+                    "size_bits": value["filter"].size_bits,
+                    "hash_count": value["filter"].hash_count
+                }
+                for key, value in self.filters.items()
+            }
+        try:
+            with open(os.path.join(DEDUPE_DIR, f"{content_hash}.bloom"), 'wb') as f:
+                f.write(bits)
+            with open(os.path.join(DEDUPE_DIR, "index.json"), 'w') as f:
+                json.dump(index, f)
+        except Exception as e:
+            logging.error(f"Error saving dedupe filter: {e}")
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            stale = [key for key, entry in self.filters.items() if now - entry["created_at"] > self.window]
+            for key in stale:
+                del self.filters[key]
+        for key in stale:
+            try:
+                os.remove(os.path.join(DEDUPE_DIR, f"{key}.bloom"))
+            except OSError:
+                pass
+
+delivery_dedupe = DeliveryDedupe(DEDUPE_WINDOW_HOURS * 3600)
+delivery_dedupe.load()
+
+# ========== CTA CLICK TRACKING ==========
+CLICK_SHARDS = 8
+
+def cta_keyboard(job_id, action):
+    label, _ = CTA_ACTIONS[action]
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(label, callback_data=f"cta_{job_id}_{action}"))
+    return markup
+
+class ClickCounter:
+    """CTA clicks per job, counted in memory and flushed to JOBS_DIR/<id>.clicks.
+    Sharded by user id so concurrent clicks rarely wait on the same lock."""
+    def __init__(self, shards=CLICK_SHARDS):
+        # Per-shard holder [lock, {job_id: [clicks, clicker ids]}]; the dict is only
+        # read or swapped with the lock held, so a drained dict is never written again
+        self.shards = [[threading.Lock(), {}] for _ in range(shards)]
+        self.flush_lock = threading.Lock()
+
+    def record(self, job_id, user_id):
+        shard = self.shards[hash(user_id) % len(self.shards)]
+        with shard[0]:
+            counts = shard[1]
+            entry = counts.get(job_id)
+            if entry is None:
+                entry = counts[job_id] = [0, set()]
+            entry[0] += 1
+            entry[1].add(user_id)
+
+    def _drain(self):
+        merged = {}
+        for shard in self.shards:
+            with shard[0]:
+                counts, shard[1] = shard[1], {}
+            for job_id, (clicks, users) in counts.items():
+                entry = merged.setdefault(job_id, [0, set()])
+                entry[0] += clicks
+                entry[1] |= users
+        return merged
+
+    @staticmethod
+    def _path(job_id):
+        return os.path.join(JOBS_DIR, f"{job_id}.clicks")
+
+    @staticmethod
+    def load(job_id):
+        try:
+            with open(ClickCounter._path(job_id), 'r') as f:
+                data = json.load(f)
+            return data["clicks"], set(data["clickers"])
+        except (OSError, ValueError, KeyError):
+            return 0, set()
+
+    def flush(self):
+        """Merge pending clicks into the per-job files (one write per job)"""
+        with self.flush_lock:
+            for job_id, (clicks, users) in self._drain().items():
+                total, clickers = self.load(job_id)
+                tmp_path = self._path(job_id) + ".tmp"
+                try:
+                    with open(tmp_path, 'w') as f:
+                        json.dump({"clicks": total + clicks, "clickers": sorted(clickers | users)}, f)
+                    os.replace(tmp_path, self._path(job_id))
+                except Exception as e:
+                    logging.error(f"Error saving clicks for job {job_id}: {e}")
+
+    def totals(self, job_id):
+        """(clicks, unique clickers) for a job, pending clicks included"""
+        self.flush()
+        clicks, clickers = self.load(job_id)
+        return clicks, len(clickers)
+
+click_counter = ClickCounter()
+
+def payload_label(payload):
+    return {
+        "photo": "Photo",
+        "video": "Video",
+        "document": "Document",
+        "animation": "GIF/Animation",
+        "text": "Text",
+        "album": "Album"
+    }[payload["type"]]
+
+INPUT_MEDIA_TYPES = {
+    "photo": types.InputMediaPhoto,
+    "video": types.InputMediaVideo,
+    "document": types.InputMediaDocument,
+    "audio": types.InputMediaAudio,
+    "animation": types.InputMediaAnimation,
+}
+
+def payload_request(payload):
+    """(method, kwargs) that sends the payload - built once per job run"""
+    kind = payload["type"]
+    if kind == "album":
+        media_group = [
+            INPUT_MEDIA_TYPES[media['type']](
+                media=media['file_id'],
+                caption=payload["text"] if idx == 0 else "",  # Caption only on first media
+                parse_mode="HTML"
+            )
+            for idx, media in enumerate(payload["media"])
+        ]
+        return "send_media_group", {"media": media_group}
+    elif kind == "text":
+        return "send_message", {"text": payload["text"], "parse_mode": "HTML"}
+    return f"send_{kind}", {kind: payload["file_id"], "caption": payload["text"], "parse_mode": "HTML"}
+
+# Placeholders filled per recipient from users_data: {name: fallback}
+TEMPLATE_FIELDS = {"first_name": "there", "last_name": "", "username": "", "user_id": None}
+TEMPLATE_PATTERN = re.compile(r"\{(" + "|".join(TEMPLATE_FIELDS) + r")\}")
+
+class CompiledTemplate:
+    """Broadcast text split once into literal chunks and placeholder names.
+    Immutable after construction, so concurrent sends can share it."""
+    __slots__ = ("text", "literals", "fields")
+
+    def __init__(self, text):
+        self.text = text or ""
+        parts = TEMPLATE_PATTERN.split(self.text)
+        self.literals = tuple(parts[0::2])
+        self.fields = tuple(parts[1::2])
+
+    def render(self, user_id, user):
+        if not self.fields:
+            return self.text
+        out = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            value = str(user_id) if field == "user_id" else (user.get(field) or TEMPLATE_FIELDS[field])
+            out.append(html.escape(value))
+            out.append(literal)
+        return "".join(out)
+
+def with_text(method, request, text):
+    """Copy of a prepared request with its text/caption replaced"""
+    if method == "send_media_group":
+        first = request["media"][0]
+        personalized = type(first)(media=first.media, caption=text, parse_mode="HTML")
+        return {"media": [personalized] + request["media"][1:]}
+    return dict(request, **{"text" if method == "send_message" else "caption": text})
+
+BROADCAST_START_RATE = float(os.environ.get("BROADCAST_START_RATE", "10"))  # messages/s
+BROADCAST_MIN_RATE = float(os.environ.get("BROADCAST_MIN_RATE", "1"))
+BROADCAST_MAX_RATE = float(os.environ.get("BROADCAST_MAX_RATE", "28"))  # Telegram allows ~30/s
+AIMD_INCREASE = 1.0  # messages/s gained per second of clean sending
+AIMD_DECREASE = 0.5  # rate multiplier on 429 or timeout
+PROGRESS_INTERVAL = 3
+
+active_rate_controllers = weakref.WeakSet()  # running broadcasts, for metrics
+
+class SendRateController:
+    """AIMD pacing for one broadcast run, with rolling throughput and error stats"""
+    def __init__(self, weight=1, window=200):
+        active_rate_controllers.add(self)
+        self.rate = BROADCAST_START_RATE
+        self.weight = weight  # messages per send (album = number of items)
+        self.events = deque(maxlen=window)  # (timestamp, ok)
+        self.started = time.time()
+        self.delivered = 0
+
+    def delay(self):
+        return self.weight / self.rate
+
+    def on_success(self):
+        # Additive increase: +AIMD_INCREASE msg/s per second's worth of sends
+        self.rate = min(BROADCAST_MAX_RATE, self.rate + AIMD_INCREASE * self.weight / self.rate)
+        self.delivered += 1
+        self.events.append((time.time(), True))
+
+    def on_error(self):
+        """Recipient-level error - counts toward the error rate, keeps the pace"""
+        self.events.append((time.time(), False))
+
+    def on_congestion(self, retry_after=None):
+        """429 or timeout: multiplicative decrease; returns how long to back off"""
+        self.rate = max(BROADCAST_MIN_RATE, self.rate * AIMD_DECREASE)
+        self.events.append((time.time(), False))
+        return retry_after if retry_after else 1
+
+    def throughput(self):
+        """Recipients per second over the recent window"""
+        if len(self.events) < 2:
+            return 0.0
+        span = time.time() - self.events[0][0]
+        return sum(1 for _, ok in self.events if ok) / span if span > 0 else 0.0
+
+    def average_throughput(self):
+        elapsed = time.time() - self.started
+        return self.delivered / elapsed if elapsed > 0 else 0.0
+
+    def error_rate(self):
+        if not self.events:
+            return 0.0
+        return sum(1 for _, ok in self.events if not ok) / len(self.events)
+
+    def eta(self, remaining):
+        speed = self.throughput() or self.rate / self.weight
+        return remaining / speed
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+def is_timeout_error(error):
+    return isinstance(error, (requests.exceptions.Timeout, asyncio.TimeoutError)) or type(error).__name__ == "RequestTimeout"
+
+BROADCAST_BREAKER_THRESHOLD = int(os.environ.get("BROADCAST_BREAKER_THRESHOLD", "10"))
+# Bad Request descriptions that are about the recipient, not the payload
+RECIPIENT_ERRORS = ("blocked", "deactivated", "chat not found", "user not found", "PEER_ID_INVALID", "kicked", "can't initiate")
+
+def is_payload_error(error):
+    """True for Bad Request errors every recipient would get (bad HTML, bad file_id, ...)"""
+    return error.error_code == 400 and not any(marker in error.description for marker in RECIPIENT_ERRORS)
+
+class CircuitBreaker:
+    """Trips when the same payload-level error repeats without any success in between"""
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.last_error = None
+        self.repeats = 0
+        self.tripped = False
+
+    def on_success(self):
+        self.last_error = None
+        self.repeats = 0
+
+    def on_error(self, error):
+        if not is_payload_error(error):
+            return
+        if error.description == self.last_error:
+            self.repeats += 1
+        else:
+            self.last_error = error.description
+            self.repeats = 1
+        if self.repeats >= self.threshold:
+            self.tripped = True
+
+def preflight(method, request, chat_id):
+    """Test-send the payload to the admin chat once (sub-flow).
+    Returns Telegram's error description if the payload itself is rejected."""
+    try:
+        yield api_call(method, chat_id, **request)
+    except telebot.apihelper.ApiTelegramException as e:
+        if is_payload_error(e):
+            return e.description
+    except Exception as e:
+        # Network trouble says nothing about the payload - let the run decide
+        logging.error(f"Broadcast preflight error: {e}")
+    return None
+
+def deliver(rate, breaker, method, user_id, request):
+    """Send to one recipient under the rate controller (sub-flow).
+    Returns the DELIVERY_* outcome; a 429 is retried once after backing off."""
+    for attempt in range(2):
+        yield pause(rate.delay())
+        try:
+            yield api_call(method, user_id, **request)
+            rate.on_success()
+            breaker.on_success()
+            return DELIVERY_SENT
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                # Rate limit hit, slow down and wait as long as Telegram asks
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after")
+                yield pause(rate.on_congestion(retry_after))
+                continue
+            rate.on_error()
+            breaker.on_error(e)
+            if "blocked" in str(e) or "deactivated" in str(e):
+                # User blocked the bot
+                return DELIVERY_DEAD
+            return DELIVERY_FAILED
+        except Exception as e:
+            if is_timeout_error(e):
+                rate.on_congestion()
+            else:
+                rate.on_error()
+            return DELIVERY_FAILED
+    return DELIVERY_THROTTLED
+
+def process_broadcast(job, chat_id, message_id, positions=None):
+    """Deliver a job to its recipients (flow, see start_flow).
+    positions limits the run to those ledger entries, e.g. a retry of failures.
+    Callers re-running an existing job reserve it first (reserve_job); the
+    reservation is released however the flow ends."""
+    reserve_job(job.job_id)
+    try:
+        return (yield from deliver_broadcast(job, chat_id, message_id, positions))
+    finally:
+        release_job(job.job_id)
+
+def deliver_broadcast(job, chat_id, message_id, positions):
+    if positions is None:
+        positions = range(len(job.user_ids))
+    total_users = len(positions)
+    method, request = payload_request(job.payload)
+    template = CompiledTemplate(job.payload["text"])
+    is_album = job.payload["type"] == "album"
+    cta_markup = cta_keyboard(job.job_id, job.meta["cta"]) if job.meta.get("cta") else None
+    if cta_markup and not is_album:
+        request = dict(request, reply_markup=cta_markup)
+    title = "Album Broadcasting..." if is_album else "Broadcasting..."
+    if is_album:
+        detail = f"⏰ <b>Media Count:</b> {len(job.payload['media'])}"
+    else:
+        detail = f"⏰ <b>Message Type:</b> {payload_label(job.payload)}"
+    rate = SendRateController(len(job.payload["media"]) if is_album else 1)
+    breaker = CircuitBreaker(BROADCAST_BREAKER_THRESHOLD)
+    
+    # One test send to the admin before paying for N identical failures.
+    # No CTA buttons on it: the admin's clicks would count in this job's CTR
+    sample = {key: value for key, value in request.items() if key != "reply_markup"} if cta_markup else request
+    if template.fields:
+        # Preview as the admin's own record so the placeholders get checked too
+        sample = with_text(method, request, template.render(chat_id, users_data.get(str(chat_id), {})))
+    rejected = yield from preflight(method, sample, chat_id)
+    if rejected:
+        job.meta["aborted"] = f"preflight: {rejected}"
+        yield blocking(job.save)
+        try:
+            yield api_call(
+                "edit_message_text",
+                f"❌ <b>Broadcast aborted - Telegram rejected the message</b>\n\n"
+                f"<code>{html.escape(rejected)}</code>\n\n"
+                f"Nothing was sent to users. Fix the text/HTML or media and broadcast again.",
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode="HTML"
+            )
+        except:
+            pass
+        return
+    
+    sent = 0
+    failed = 0
+    skipped = 0
+    
+    job.meta["runs"] += 1
+    last_flush = last_progress = time.time()
+    content_hash = job.meta.setdefault("content_hash", payload_hash(job.payload))
+    recent = delivery_dedupe.get(content_hash) if job.meta.get("dedupe", True) else None
+    duplicates = 0
+    
+    for idx, pos in enumerate(positions):
+        if breaker.tripped:
+            job.meta["aborted"] = f"circuit breaker: {breaker.last_error}"
+            break
+        
+        user_id = job.user_ids[pos]
+        user_id_str = str(user_id)
+        
+        # Skip if user is blocked
+        if user_id_str in spam_data and spam_data[user_id_str].get("blocked_until", 0) > time.time():
+            outcome = DELIVERY_SKIPPED
+        elif recent is not None and user_id in recent:
+            # Already got identical content inside the dedupe window
+            outcome = DELIVERY_DUPLICATE
+        elif template.fields:
+            text = template.render(user_id, users_data.get(user_id_str, {}))
+            outcome = yield from deliver(rate, breaker, method, user_id, with_text(method, request, text))
+        else:
+            outcome = yield from deliver(rate, breaker, method, user_id, request)
+        
+        if outcome == DELIVERY_SENT and cta_markup and is_album:
+            # Media groups can't carry a keyboard - the button follows the album
+            yield from deliver(rate, breaker, "send_message", user_id, {"text": CTA_ALBUM_PROMPT, "reply_markup": cta_markup})
+        
+        job.mark(pos, outcome)
+        broadcast_deliveries.inc(DELIVERY_NAMES[outcome])
+        if outcome == DELIVERY_SENT:
+            sent += 1
+            if recent is not None:
+                recent.add(user_id)
+        elif outcome == DELIVERY_DUPLICATE:
+            duplicates += 1
+        elif outcome == DELIVERY_SKIPPED:
+            skipped += 1
+        else:
+            failed += 1
+        
+        now = time.time()
+        if now - last_flush > JOB_FLUSH_SECONDS:
+            # File writes: off the event loop in the async runtime
+            yield blocking(job.save)
+            yield blocking(delivery_dedupe.save, content_hash)
+            last_flush = now
+        
+        # Update progress every few seconds
+        if now - last_progress >= PROGRESS_INTERVAL:
+            last_progress = now
+            percent = int((idx + 1) / total_users * 100)
+            status_text = f"""
+📤 <b>{title}</b>
+
+📊 Progress: <b>{percent}%</b>
+┌─────────────────────┐
+│ ✅ Sent: {sent:>6}   │
+│ ❌ Failed: {failed:>5} │
+│ ⏭️ Skipped: {skipped:>4} │
+│ ♻️ Duplicates: {duplicates:>3} │
+│ 👥 Total: {total_users:>6} │
+└─────────────────────┘
+
+⚡ <b>Speed:</b> {rate.throughput():.1f} users/s (limit {rate.rate / rate.weight:.1f})
+⚠️ <b>Error rate:</b> {rate.error_rate() * 100:.1f}%
+⏳ <b>ETA:</b> {format_duration(rate.eta(total_users - idx - 1))}
+{detail}
+            """
+            try:
+                yield api_call(
+                    "edit_message_text",
+                    status_text,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    parse_mode="HTML"
+                )
+            except:
+                pass
+    
+    yield blocking(job.save)
+    yield blocking(delivery_dedupe.save, content_hash)
+    counts = job.meta["counts"]
+    retryable = counts["failed"] + counts["throttled"]
+    
+    # Final result
+    final_text = f"""
+✅ <b>{'ALBUM ' if is_album else ''}BROADCAST COMPLETE!</b>
+
+📊 <b>Results:</b>
+┌─────────────────────┐
+│ ✅ Successfully Sent: {sent}   │
+│ ❌ Failed to Send: {failed} │
+│ ⏭️ Skipped (Blocked): {skipped} │
+│ ♻️ Duplicates: {duplicates} │
+│ 👥 Total Users: {total_users} │
+└─────────────────────┘
+
+{detail}
+⚡ <b>Average speed:</b> {rate.average_throughput():.1f} users/s over {format_duration(time.time() - rate.started)}
+🆔 <b>Job:</b> <code>{job.job_id}</code> ({counts['dead']} dead, {counts['throttled']} throttled)
+⏰ <b>Completed at:</b> {datetime.now().strftime("%H:%M:%S")}
+
+<b>✅ Broadcast successfully delivered to {sent} users.</b>
+    """
+    if breaker.tripped:
+        final_text = (
+            f"⛔ <b>BROADCAST ABORTED</b> - the same error repeated {breaker.repeats} times:\n"
+            f"<code>{html.escape(breaker.last_error)}</code>\n"
+            f"{counts['pending']} users were not attempted.\n"
+        ) + final_text
+    elif retryable:
+        final_text += f"\n🔁 Retry {retryable} failed: <code>/retryjob {job.job_id}</code>"
+    
+    try:
+        yield api_call(
+            "edit_message_text",
+            final_text,
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode="HTML"
+        )
+    except:
+        pass
+    
+    # Log to admin
+    try:
+        log_msg = f"""
+{'📸' if is_album else '📢'} <b>{'ALBUM ' if is_album else ''}BROADCAST COMPLETED</b>
+
+👮 Admin: @{job.meta['admin']}
+🆔 Job: <code>{job.job_id}</code>
+📊 Results: {sent} sent, {failed} failed, {skipped} skipped, {duplicates} duplicates
+📝 Type: {payload_label(job.payload)}
+📝 Caption: {'Yes' if job.payload['text'] else 'No'}
+👥 Total Users: {total_users}
+🕒 Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        """
+        yield api_call("send_message", ADMIN_ID, log_msg, parse_mode="HTML")
+    except:
+        pass
+
+def admin_label(user):
+    return user.username if user.username else user.id
+
+def start_album_job(chat_id, message_id, queue_id, caption, admin):
+    """Turn a finished album session into a broadcast job and start it"""
+    queue = album_sessions.get(queue_id)
+    if queue is None:
+        bot.edit_message_text("❌ Album session expired!", chat_id=chat_id, message_id=message_id, parse_mode="HTML")
+        return
+    
+    try:
+        user_ids = build_audience(queue.get("segment", ""))
+    except ValueError:
+        user_ids = []
+    album_sessions.remove(queue_id)
+    
+    if not user_ids:
+        bot.edit_message_text("❌ No users to broadcast", chat_id=chat_id, message_id=message_id, parse_mode="HTML")
+        return
+    
+    job = BroadcastJob.create(
+        album_payload(queue["collected"], caption),
+        user_ids,
+        queue.get("segment", ""),
+        admin,
+        dedupe=not queue.get("force", False),
+        cta=queue.get("cta")
+    )
+    start_flow(process_broadcast, job, chat_id, message_id)
+
+# ========== MEDIA GROUP AGGREGATOR ==========
+MEDIA_GROUP_IDLE_SECONDS = float(os.environ.get("MEDIA_GROUP_IDLE_SECONDS", "1.5"))
+MEDIA_GROUP_KEEP = 50  # completed albums remembered for /mbroadcast
+
+def extract_media(message):
+    """Return (media_type, file_id) of a media message, or (None, None)"""
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    elif message.video:
+        return "video", message.video.file_id
+    elif message.document:
+        return "document", message.document.file_id
+    elif message.audio:
+        return "audio", message.audio.file_id
+    elif message.animation:
+        return "animation", message.animation.file_id
+    return None, None
+
+class MediaGroupAggregator:
+    """Buffers album messages by media_group_id and finalizes them after an idle timer"""
+    def __init__(self, idle_seconds, keep):
+        self.idle_seconds = idle_seconds
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.groups = OrderedDict()
+
+    def add(self, message):
+        """Add one album item; (re)arms the idle timer of its group"""
+        media_type, file_id = extract_media(message)
+        if not media_type:
+            return
+        
+        with self.lock:
+            group = self.groups.get(message.media_group_id)
+            if group is None:
+                group = {"items": {}, "caption": "", "complete": False, "timer": None, "waiters": []}
+                self.groups[message.media_group_id] = group
+                self._evict()
+            elif group["complete"]:
+                # Straggler after finalize - reopen the group
+                group["complete"] = False
+            
+            group["items"][message.message_id] = {
+                "type": media_type,
+                "file_id": file_id,
+                "message_id": message.message_id
+            }
+            if message.caption:
+                group["caption"] = message.caption
+            
+            if group["timer"]:
+                group["timer"].cancel()
+            group["timer"] = schedule_later(self.idle_seconds, self._finalize, message.media_group_id)
+
+    def when_complete(self, media_group_id, callback):
+        """Call callback(items, caption) once the album is complete.
+        Returns False if the album was never seen by the bot."""
+        with self.lock:
+            group = self.groups.get(media_group_id)
+            if group is None:
+                return False
+            if not group["complete"]:
+                group["waiters"].append(callback)
+                return True
+            items, caption = self._ordered(group), group["caption"]
+        
+        callback(items, caption)
+        return True
+
+    def _finalize(self, media_group_id):
+        with self.lock:
+            group = self.groups.get(media_group_id)
+            if group is None:
+                return
+            group["complete"] = True
+            group["timer"] = None
+            waiters, group["waiters"] = group["waiters"], []
+            items, caption = self._ordered(group), group["caption"]
+        
+        for callback in waiters:
+            try:
+                callback(items, caption)
+            except Exception as e:
+                logging.error(f"Media group callback error: {e}")
+
+    def _ordered(self, group):
+        return [group["items"][mid] for mid in sorted(group["items"])]
+
+    def _evict(self):
+        # Forget the oldest finished albums; never drop one still collecting
+        for mgid in list(self.groups):
+            if len(self.groups) <= self.keep:
+                break
+            if self.groups[mgid]["complete"]:
+                del self.groups[mgid]
+
+media_groups = MediaGroupAggregator(MEDIA_GROUP_IDLE_SECONDS, MEDIA_GROUP_KEEP)
+
+def start_album_broadcast(chat_id, message_id, media_list, caption, segment_spec, admin, dedupe=True, cta=None):
+    """Broadcast a complete album as a job in the background"""
+    try:
+        user_ids = build_audience(segment_spec)
+    except ValueError:
+        user_ids = []
+    if not user_ids:
+        bot.edit_message_text("❌ No users to broadcast", chat_id=chat_id, message_id=message_id, parse_mode="HTML")
+        return
+    
+    job = BroadcastJob.create(album_payload(media_list, caption), user_ids, segment_spec, admin, dedupe, cta)
+    start_flow(process_broadcast, job, chat_id, message_id)
+
+# ========== MULTI-MEDIA BROADCAST COMMAND ==========
+@bot.message_handler(commands=['mbroadcast'])
+def handle_multi_broadcast(message):
+    """Broadcast multiple media files as album"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return  # Silent fail for non-admin
+    
+    if not message.reply_to_message:
+        help_text = """
+<b>📢 MULTI-MEDIA BROADCAST COMMAND</b>
+
+<code>Reply to a message with /mbroadcast</code>
+
+<b>Supported Media Types:</b>
+✅ Multiple Photos (2-10)
+✅ Multiple Videos (2-10)  
+✅ Mixed Photo+Video (2-10)
+✅ Photo + Video + Document
+✅ With or Without Caption
+
+<b>How to use:</b>
+1. Send multiple photos/videos/documents as an <b>ALBUM</b>
+2. Reply to ANY media in that album with <code>/mbroadcast</code>
+3. Bot will broadcast the ENTIRE album to all users
+
+<b>📝 Example:</b>
+• Send 5 photos together (as album)
+• Reply to any one with /mbroadcast
+• All 5 photos will be broadcast as album
+• <code>/mbroadcast new:7</code> - only to a segment (see /segment)
+• <code>/mbroadcast cta:premium</code> - follow the album with a tracked button (see /ctr)
+
+<b>⚠️ Note:</b> Media group limited to 10 items
+        """
+        bot.reply_to(message, help_text, parse_mode="HTML")
+        return
+    
+    replied_msg = message.reply_to_message
+    
+    # Check if this message is part of a media group
+    if not replied_msg.media_group_id:
+        bot.reply_to(message, "❌ This message is not part of a media group! Send multiple media files together as an album.")
+        return
+    
+    args = message.text.split(maxsplit=1)
+    try:
+        segment_spec, force, cta = split_flags(args[1] if len(args) > 1 else "")
+        parse_segment(segment_spec)
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {html.escape(str(e))}\n{SEGMENT_HELP}", parse_mode="HTML")
+        return
+    
+    # Progress message
+    progress_msg = bot.reply_to(message, "📤 <b>Collecting media group...</b>", parse_mode="HTML")
+    
+    def on_album_complete(media_list, caption):
+        try:
+            bot.edit_message_text(
+                f"📥 <b>Album collected: {len(media_list)} items</b>\n\n🚀 Starting album broadcast...",
+                chat_id=message.chat.id,
+                message_id=progress_msg.message_id,
+                parse_mode="HTML"
+            )
+        except:
+            pass
+        start_album_broadcast(
+            message.chat.id, progress_msg.message_id, media_list, caption,
+            segment_spec, admin_label(message.from_user), not force, cta
+        )
+    
+    # Album items that arrive late finish the group on the aggregator's timer
+    if not media_groups.when_complete(replied_msg.media_group_id, on_album_complete):
+        bot.edit_message_text(
+            "⚠️ <b>This album was not received by the bot.</b>\n\nSend the album here again, then reply to it with <code>/mbroadcast</code>.",
+            chat_id=message.chat.id,
+            message_id=progress_msg.message_id,
+            parse_mode="HTML"
+        )
+
+# ========== ALBUM BROADCAST COMMAND ==========
+@bot.message_handler(commands=['albumcast'])
+def handle_album_cast(message):
+    """Broadcast album by replying to multiple messages sequentially"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    args = message.text.split()
+    
+    if len(args) < 2:
+        help_text = """
+<b>📸 ALBUM BROADCAST COMMAND</b>
+
+<code>/albumcast &lt;number_of_media&gt;</code>
 
 <b>How to use:</b>
 1. Send <code>/albumcast 5</code> (for 5 photos)
@@ -655,6 +3580,8 @@ def handle_album_cast(message):
 
 <b>Example:</b>
 <code>/albumcast 3</code> - For 3 photos/videos
+<code>/albumcast 3 new:7</code> - Only users who joined in the last 7 days
+<code>/albumcast 3 cta:premium</code> - Follow the album with a tracked Get Premium button
         """
         bot.reply_to(message, help_text, parse_mode="HTML")
         return
@@ -665,17 +3592,20 @@ def handle_album_cast(message):
             bot.reply_to(message, "❌ Media count must be between 2 and 10")
             return
         
+        segment_spec, force, cta = split_flags(" ".join(args[2:]))
+        parse_segment(segment_spec)
+        
         # Store in queue
-        queue_id = f"album_{message.from_user.id}_{int(time.time())}"
-        broadcast_queue[queue_id] = {
-            "user_id": message.from_user.id,
-            "expected_count": media_count,
-            "collected": [],
-            "status": "collecting",
-            "caption": "",
-            "created_at": time.time()
-        }
-        save_broadcast_queue()
+        album_sessions.create(
+            message.from_user.id,
+            "collecting",
+            expected_count=media_count,
+            collected=[],
+            caption="",
+            segment=segment_spec,
+            force=force,
+            cta=cta
+        )
         
         bot.reply_to(
             message, 
@@ -688,8 +3618,11 @@ def handle_album_cast(message):
             parse_mode="HTML"
         )
         
-    except ValueError:
-        bot.reply_to(message, "❌ Invalid number. Use: /albumcast 5")
+    except ValueError as e:
+        if args[1].isdigit():
+            bot.reply_to(message, f"❌ {html.escape(str(e))}\n{SEGMENT_HELP}", parse_mode="HTML")
+        else:
+            bot.reply_to(message, "❌ Invalid number. Use: /albumcast 5")
 
 # Handle media for album broadcast
 @bot.message_handler(content_types=['photo', 'video', 'document', 'audio', 'animation'])
@@ -698,60 +3631,37 @@ def handle_album_media(message):
     if str(message.from_user.id) != ADMIN_ID:
         return
     
+    # Remember admin albums so /mbroadcast can send them in one go
+    if message.media_group_id:
+        media_groups.add(message)
+    
     # Check if user has active album collection
     user_id = message.from_user.id
-    active_queue = None
-    queue_id = None
-    
-    for qid, queue in broadcast_queue.items():
-        if queue.get("user_id") == user_id and queue.get("status") == "collecting":
-            active_queue = queue
-            queue_id = qid
-            break
+    queue_id, active_queue = album_sessions.find(user_id, "collecting")
     
     if not active_queue:
         return  # No active collection
     
     # Determine media type and file_id
-    media_type = None
-    file_id = None
-    
-    if message.photo:
-        media_type = "photo"
-        file_id = message.photo[-1].file_id
-    elif message.video:
-        media_type = "video"
-        file_id = message.video.file_id
-    elif message.document:
-        media_type = "document"
-        file_id = message.document.file_id
-    elif message.audio:
-        media_type = "audio"
-        file_id = message.audio.file_id
-    elif message.animation:
-        media_type = "animation"
-        file_id = message.animation.file_id
+    media_type, file_id = extract_media(message)
     
     if not media_type:
         bot.reply_to(message, "❌ Unsupported media type")
         return
     
-    # Add to collection
-    active_queue["collected"].append({
+    # Add to collection (under the session lock: auto-save serializes this store)
+    counts = album_sessions.add_media(queue_id, {
         "type": media_type,
         "file_id": file_id,
         "message_id": message.message_id
     })
-    
-    save_broadcast_queue()
-    
-    current = len(active_queue["collected"])
-    expected = active_queue["expected_count"]
+    if counts is None:
+        return  # Cancelled or expired meanwhile
+    current, expected = counts
     
     if current >= expected:
         # All media collected, ask for caption
-        active_queue["status"] = "caption"
-        save_broadcast_queue()
+        album_sessions.set_status(queue_id, "caption")
         
         # Create preview keyboard
         keyboard = types.InlineKeyboardMarkup(row_width=2)
@@ -823,16 +3733,14 @@ def handle_album_callbacks(call):
     action = call.data.split('_')[1]
     queue_id = '_'.join(call.data.split('_')[2:])
     
-    if queue_id not in broadcast_queue:
+    queue = album_sessions.get(queue_id)
+    if queue is None or queue.get("status") == "broadcasting":
         bot.answer_callback_query(call.id, "Album session expired!")
         return
     
-    queue = broadcast_queue[queue_id]
-    
     if action == "caption":
         # Ask for caption
-        queue["status"] = "waiting_caption"
-        save_broadcast_queue()
+        album_sessions.set_status(queue_id, "waiting_caption")
         
         bot.edit_message_text(
             "📝 <b>Send the caption for this album</b>\n\n"
@@ -854,17 +3762,12 @@ def handle_album_callbacks(call):
         )
         bot.answer_callback_query(call.id)
         
-        # Start broadcast in thread
-        thread = threading.Thread(
-            target=process_album_broadcast,
-            args=(call.message.chat.id, call.message.message_id, queue_id, "")
-        )
-        thread.start()
+        # Start broadcast in background
+        start_album_job(call.message.chat.id, call.message.message_id, queue_id, "", admin_label(call.from_user))
         
     elif action == "cancel":
         # Cancel album
-        del broadcast_queue[queue_id]
-        save_broadcast_queue()
+        album_sessions.remove(queue_id)
         
         bot.edit_message_text(
             "❌ Album broadcast cancelled.",
@@ -883,14 +3786,7 @@ def handle_album_caption(message):
     
     # Check if user is in caption waiting state
     user_id = message.from_user.id
-    active_queue = None
-    queue_id = None
-    
-    for qid, queue in broadcast_queue.items():
-        if queue.get("user_id") == user_id and queue.get("status") == "waiting_caption":
-            active_queue = queue
-            queue_id = qid
-            break
+    queue_id, active_queue = album_sessions.find(user_id, "waiting_caption")
     
     if not active_queue:
         return
@@ -903,200 +3799,8 @@ def handle_album_caption(message):
     # Start broadcast with caption
     progress_msg = bot.reply_to(message, "🚀 <b>Starting album broadcast...</b>", parse_mode="HTML")
     
-    # Start broadcast in thread
-    thread = threading.Thread(
-        target=process_album_broadcast,
-        args=(message.chat.id, progress_msg.message_id, queue_id, caption)
-    )
-    thread.start()
-
-def process_album_broadcast(chat_id, message_id, queue_id, caption):
-    """Process album broadcast to all users"""
-    if queue_id not in broadcast_queue:
-        try:
-            bot.edit_message_text(
-                "❌ Album session expired!",
-                chat_id=chat_id,
-                message_id=message_id,
-                parse_mode="HTML"
-            )
-        except:
-            pass
-        return
-    
-    queue = broadcast_queue[queue_id]
-    media_list = queue["collected"]
-    total_users = len(users_data)
-    
-    if total_users == 0:
-        try:
-            bot.edit_message_text(
-                "❌ No users to broadcast",
-                chat_id=chat_id,
-                message_id=message_id,
-                parse_mode="HTML"
-            )
-        except:
-            pass
-        return
-    
-    # Create media group for broadcast
-    media_group = []
-    for idx, media in enumerate(media_list):
-        if media['type'] == 'photo':
-            media_group.append(
-                types.InputMediaPhoto(
-                    media=media['file_id'],
-                    caption=caption if idx == 0 else "",  # Caption only on first media
-                    parse_mode="HTML"
-                )
-            )
-        elif media['type'] == 'video':
-            media_group.append(
-                types.InputMediaVideo(
-                    media=media['file_id'],
-                    caption=caption if idx == 0 else "",
-                    parse_mode="HTML"
-                )
-            )
-        elif media['type'] == 'document':
-            media_group.append(
-                types.InputMediaDocument(
-                    media=media['file_id'],
-                    caption=caption if idx == 0 else "",
-                    parse_mode="HTML"
-                )
-            )
-        elif media['type'] == 'audio':
-            media_group.append(
-                types.InputMediaAudio(
-                    media=media['file_id'],
-                    caption=caption if idx == 0 else "",
-                    parse_mode="HTML"
-                )
-            )
-        elif media['type'] == 'animation':
-            media_group.append(
-                types.InputMediaAnimation(
-                    media=media['file_id'],
-                    caption=caption if idx == 0 else "",
-                    parse_mode="HTML"
-                )
-            )
-    
-    sent = 0
-    failed = 0
-    skipped = 0
-    
-    user_ids = list(users_data.keys())
-    
-    for idx, user_id_str in enumerate(user_ids):
-        try:
-            user_id = int(user_id_str)
-            
-            # Skip if user is blocked
-            if user_id_str in spam_data:
-                user_spam_data = spam_data[user_id_str]
-                if user_spam_data.get("blocked_until", 0) > time.time():
-                    skipped += 1
-                    continue
-            
-            # Send media group
-            bot.send_media_group(
-                user_id,
-                media=media_group
-            )
-            
-            sent += 1
-            
-            # Update progress every 10 users
-            if idx % 10 == 0 or idx == total_users - 1:
-                percent = int((idx + 1) / total_users * 100)
-                status_text = f"""
-📤 <b>Album Broadcasting...</b>
-
-📊 Progress: <b>{percent}%</b>
-┌─────────────────────┐
-│ ✅ Sent: {sent:>6}   │
-│ ❌ Failed: {failed:>5} │
-│ ⏭️ Skipped: {skipped:>4} │
-│ 👥 Total: {total_users:>6} │
-└─────────────────────┘
-
-⏰ <b>Media Count:</b> {len(media_list)}
-                """
-                try:
-                    bot.edit_message_text(
-                        status_text,
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        parse_mode="HTML"
-                    )
-                except:
-                    pass
-            
-            # Small delay to avoid flooding
-            time.sleep(0.2)
-            
-        except telebot.apihelper.ApiTelegramException as e:
-            if "blocked" in str(e) or "deactivated" in str(e):
-                failed += 1
-            elif "Too Many Requests" in str(e):
-                time.sleep(2)
-                failed += 1
-            else:
-                failed += 1
-        except Exception as e:
-            failed += 1
-    
-    # Final result
-    final_text = f"""
-✅ <b>ALBUM BROADCAST COMPLETE!</b>
-
-📊 <b>Results:</b>
-┌─────────────────────┐
-│ ✅ Successfully Sent: {sent}   │
-│ ❌ Failed to Send: {failed} │
-│ ⏭️ Skipped (Blocked): {skipped} │
-│ 👥 Total Users: {total_users} │
-└─────────────────────┘
-
-📝 <b>Media Items:</b> {len(media_list)}
-📝 <b>Caption:</b> {'Yes' if caption else 'No'}
-⏰ <b>Completed at:</b> {datetime.now().strftime("%H:%M:%S")}
-
-<b>✅ Album broadcast successfully delivered to {sent} users.</b>
-    """
-    
-    try:
-        bot.edit_message_text(
-            final_text,
-            chat_id=chat_id,
-            message_id=message_id,
-            parse_mode="HTML"
-        )
-    except:
-        pass
-    
-    # Clean up
-    del broadcast_queue[queue_id]
-    save_broadcast_queue()
-    
-    # Log to admin
-    try:
-        log_msg = f"""
-📸 <b>ALBUM BROADCAST COMPLETED</b>
-
-👮 Admin: @{bot.get_me().username}
-📊 Results: {sent} sent, {failed} failed, {skipped} skipped
-📝 Media Items: {len(media_list)}
-📝 Caption: {'Yes' if caption else 'No'}
-👥 Total Users: {total_users}
-🕒 Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-        """
-        bot.send_message(ADMIN_ID, log_msg, parse_mode="HTML")
-    except:
-        pass
+    # Start broadcast in background
+    start_album_job(message.chat.id, progress_msg.message_id, queue_id, caption, admin_label(message.from_user))
 
 # ========== /BROADCAST COMMAND (Single Media) ==========
 @bot.message_handler(commands=['broadcast'])
@@ -1123,198 +3827,55 @@ def handle_broadcast(message):
 2. Reply to that message with <code>/broadcast</code>
 3. Bot will send to all users
 
+<b>Targeting:</b> <code>/broadcast new:7 nopay</code> sends only to that segment (see /segment)
+<b>Duplicates:</b> users who already got the same content recently are skipped; add <code>force</code> to send anyway
+<b>Personalize:</b> <code>{first_name}</code>, <code>{last_name}</code>, <code>{username}</code> and <code>{user_id}</code> are filled in per user
+<b>Button:</b> add <code>cta:premium</code> or <code>cta:howto</code> for a tracked button (see /ctr)
+
 <b>⚠️ Warning:</b> This may take time for large user base.
         """
         bot.reply_to(message, help_text, parse_mode="HTML")
         return
     
     replied_msg = message.reply_to_message
-    sent = 0
-    failed = 0
-    skipped = 0
+    payload = message_payload(replied_msg)
+    if payload is None:
+        bot.reply_to(message, "❌ Unsupported message type for broadcast")
+        return
+    
+    # Build target list for the requested segment
+    args = message.text.split(maxsplit=1)
+    try:
+        segment_spec, force, cta = split_flags(args[1] if len(args) > 1 else "")
+        user_ids = build_audience(segment_spec)
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {html.escape(str(e))}\n{SEGMENT_HELP}", parse_mode="HTML")
+        return
     
     # Progress message
     progress_msg = bot.reply_to(message, "📤 <b>Broadcast Starting...</b>\n\n⏳ Preparing to send...", parse_mode="HTML")
     
-    total_users = len(users_data)
+    total_users = len(user_ids)
     if total_users == 0:
         bot.edit_message_text(
             "❌ <b>No users to broadcast</b>", 
-            chat_id=message.chat.id, 
-            message_id=progress_msg.message_id,
-            parse_mode="HTML"
-        )
-        return
-    
-    # Get message details for logging
-    msg_type = "Text"
-    if replied_msg.photo:
-        msg_type = "Photo"
-    elif replied_msg.video:
-        msg_type = "Video"
-    elif replied_msg.document:
-        msg_type = "Document"
-    elif replied_msg.animation:
-        msg_type = "GIF/Animation"
-    
-    print(f"📢 Starting broadcast: {msg_type} to {total_users} users")
-    
-    # Start broadcast in background thread
-    def broadcast_thread():
-        nonlocal sent, failed, skipped
-        user_ids = list(users_data.keys())
-        
-        for idx, user_id_str in enumerate(user_ids):
-            try:
-                user_id = int(user_id_str)
-                
-                # Skip if user is blocked
-                if user_id_str in spam_data:
-                    user_spam_data = spam_data[user_id_str]
-                    if user_spam_data.get("blocked_until", 0) > time.time():
-                        skipped += 1
-                        continue
-                
-                # Send based on message type
-                if replied_msg.photo:
-                    # Send photo with caption
-                    caption = replied_msg.caption or ""
-                    bot.send_photo(
-                        user_id,
-                        photo=replied_msg.photo[-1].file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.video:
-                    # Send video with caption
-                    caption = replied_msg.caption or ""
-                    bot.send_video(
-                        user_id,
-                        video=replied_msg.video.file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.document:
-                    # Send document with caption
-                    caption = replied_msg.caption or ""
-                    bot.send_document(
-                        user_id,
-                        document=replied_msg.document.file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.animation:
-                    # Send animation (GIF) with caption
-                    caption = replied_msg.caption or ""
-                    bot.send_animation(
-                        user_id,
-                        animation=replied_msg.animation.file_id,
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
-                elif replied_msg.text:
-                    # Send text message
-                    text = replied_msg.text
-                    bot.send_message(user_id, text, parse_mode="HTML")
-                elif replied_msg.caption:
-                    # Send caption only
-                    text = replied_msg.caption
-                    bot.send_message(user_id, text, parse_mode="HTML")
-                else:
-                    # Unsupported message type
-                    failed += 1
-                    continue
-                
-                sent += 1
-                
-                # Update progress every 10 users
-                if idx % 10 == 0 or idx == total_users - 1:
-                    percent = int((idx + 1) / total_users * 100)
-                    status_text = f"""
-📤 <b>Broadcasting...</b>
-
-📊 Progress: <b>{percent}%</b>
-┌─────────────────────┐
-│ ✅ Sent: {sent:>6}   │
-│ ❌ Failed: {failed:>5} │
-│ ⏭️ Skipped: {skipped:>4} │
-│ 👥 Total: {total_users:>6} │
-└─────────────────────┘
-
-⏰ <b>Message Type:</b> {msg_type}
-                    """
-                    try:
-                        bot.edit_message_text(
-                            status_text,
-                            chat_id=message.chat.id,
-                            message_id=progress_msg.message_id,
-                            parse_mode="HTML"
-                        )
-                    except:
-                        pass
-                
-                # Small delay to avoid flooding
-                time.sleep(0.1)
-                
-            except telebot.apihelper.ApiTelegramException as e:
-                if "blocked" in str(e) or "deactivated" in str(e):
-                    # User blocked the bot
-                    failed += 1
-                elif "Too Many Requests" in str(e):
-                    # Rate limit hit, wait and continue
-                    time.sleep(2)
-                    failed += 1
-                else:
-                    failed += 1
-            except Exception as e:
-                failed += 1
-        
-        # Final result
-        final_text = f"""
-✅ <b>BROADCAST COMPLETE!</b>
-
-📊 <b>Results:</b>
-┌─────────────────────┐
-│ ✅ Successfully Sent: {sent}   │
-│ ❌ Failed to Send: {failed} │
-│ ⏭️ Skipped (Blocked): {skipped} │
-│ 👥 Total Users: {total_users} │
-└─────────────────────┘
-
-📝 <b>Message Type:</b> {msg_type}
-⏰ <b>Completed at:</b> {datetime.now().strftime("%H:%M:%S")}
-
-<b>✅ Broadcast successfully delivered to {sent} users.</b>
-        """
-        
-        try:
-            bot.edit_message_text(
-                final_text,
-                chat_id=message.chat.id,
-                message_id=progress_msg.message_id,
-                parse_mode="HTML"
-            )
-        except:
-            pass
-        
-        # Log to admin
-        try:
-            log_msg = f"""
-📢 <b>BROADCAST COMPLETED</b>
-
-👮 Admin: @{message.from_user.username if message.from_user.username else message.from_user.id}
-📊 Results: {sent} sent, {failed} failed, {skipped} skipped
-📝 Type: {msg_type}
-👥 Total Users: {total_users}
-🕒 Time: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-            """
-            bot.send_message(ADMIN_ID, log_msg, parse_mode="HTML")
-        except:
-            pass
+            chat_id=message.chat.id, 
+            message_id=progress_msg.message_id,
+            parse_mode="HTML"
+        )
+        return
+    
+    # Get message details for logging
+    msg_type = payload_label(payload)
+    
+    job = BroadcastJob.create(payload, user_ids, segment_spec, admin_label(message.from_user), dedupe=not force, cta=cta)
+    broadcast_log.info(
+        f"📢 Starting broadcast {job.job_id}: {msg_type} to {total_users} users (segment: {segment_spec or 'all'})",
+        extra={"event": "broadcast_start", "job_id": job.job_id, "kind": msg_type, "users": total_users, "segment": segment_spec or "all"}
+    )
     
     # Start broadcast in background
-    thread = threading.Thread(target=broadcast_thread, daemon=True)
-    thread.start()
+    start_flow(process_broadcast, job, message.chat.id, progress_msg.message_id)
     
     bot.reply_to(message, f"📢 <b>Broadcast started!</b>\n\n⏳ Sending {msg_type} to {total_users} users...", parse_mode="HTML")
 
@@ -1459,11 +4020,13 @@ def handle_impdata(message):
                     
             except Exception as e:
                 error_count += 1
-                print(f"Error importing user {user_id_str}: {e}")
+                admin_log.warning(f"Error importing user {user_id_str}: {e}", extra={"event": "import", "user_id": user_id_str})
         
         # Save to persistent storage
         save_users_data()
         save_spam_data()
+        audience_index.rebuild()
+        payment_verifier.rebuild()
         
         # Cleanup temp file
         os.remove(temp_path)
@@ -1541,7 +4104,7 @@ def handle_impdata(message):
             message_id=status_msg.message_id,
             parse_mode="HTML"
         )
-        print(f"Import error: {e}")
+        admin_log.exception(f"Import error: {e}", extra={"event": "import"})
 
 # ========== /EXPORTDATA COMMAND ==========
 @bot.message_handler(commands=['exportdata'])
@@ -1570,6 +4133,7 @@ def handle_export_data(message):
                 "max_spam_count": MAX_SPAM_COUNT,
                 "spam_time_window": SPAM_TIME_WINDOW,
                 "amount": AMOUNT,
+                "price_tiers": PRICE_TIERS,
                 "upi_id": UPI_ID,
                 "upi_name": UPI_NAME,
                 "support_username": SUPPORT_USERNAME,
@@ -1624,7 +4188,7 @@ def handle_export_data(message):
             )
         
         # Keep file in data directory
-        print(f"✅ Export saved: {filepath}")
+        admin_log.info(f"✅ Export saved: {filepath}", extra={"event": "export", "file": filepath})
         
         bot.delete_message(message.chat.id, status_msg.message_id)
         
@@ -1848,6 +4412,7 @@ def handle_set_start_message(message):
     
     # Save to file
     save_start_message()
+    responses.rebuild()
     
     bot.reply_to(message, "✅ Start message updated!")
 
@@ -1870,14 +4435,20 @@ def handle_start(message):
         # Check if new user
         is_new_user = str(user_id) not in users_data
         
-        # Store user data
-        users_data[str(user_id)] = {
+        # Store user data (keep segment fields from earlier visits)
+        user_record = users_data.get(str(user_id), {})
+        # Backfill from the old start_time before it is overwritten: a returning
+        # user from before joined_at existed must not look new to new:N
+        user_record['joined_at'] = time.time() if is_new_user else user_joined_at(user_record)
+        user_record.update({
             'id': user_id,
             'username': message.from_user.username,
             'first_name': message.from_user.first_name,
             'last_name': message.from_user.last_name or "",
             'start_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
+        })
+        users_data[str(user_id)] = user_record
+        audience_index.record_join(str(user_id), user_record['joined_at'])
         
         # Reset spam counter for legit users
         reset_spam_counter(user_id)
@@ -1886,91 +4457,21 @@ def handle_start(message):
         if is_new_user:
             log_important_event("new_user", users_data[str(user_id)])
         
-        # Check if custom start message exists
-        if start_message_data and 'has_media' in start_message_data:
-            # Send custom start message
-            text = start_message_data.get('text', "")
-            
-            if start_message_data['has_media']:
-                media_type = start_message_data.get('media_type', '')
-                file_id = start_message_data.get('file_id', '')
-                
-                if media_type == 'photo' and file_id:
-                    bot.send_photo(
-                        message.chat.id,
-                        photo=file_id,
-                        caption=text,
-                        reply_markup=premium_bot.main_menu_keyboard(),
-                        parse_mode="HTML"
-                    )
-                elif media_type == 'video' and file_id:
-                    bot.send_video(
-                        message.chat.id,
-                        video=file_id,
-                        caption=text,
-                        reply_markup=premium_bot.main_menu_keyboard(),
-                        parse_mode="HTML"
-                    )
-                elif media_type == 'document' and file_id:
-                    bot.send_document(
-                        message.chat.id,
-                        document=file_id,
-                        caption=text,
-                        reply_markup=premium_bot.main_menu_keyboard(),
-                        parse_mode="HTML"
-                    )
-                elif media_type == 'animation' and file_id:
-                    bot.send_animation(
-                        message.chat.id,
-                        animation=file_id,
-                        caption=text,
-                        reply_markup=premium_bot.main_menu_keyboard(),
-                        parse_mode="HTML"
-                    )
-                else:
-                    # Fallback to default message
-                    send_default_start_message(message)
-            else:
-                # Only text message
-                bot.send_message(
-                    message.chat.id,
-                    text,
-                    reply_markup=premium_bot.main_menu_keyboard(),
-                    parse_mode="HTML"
-                )
-        else:
-            # Send default start message
-            send_default_start_message(message)
+        # Custom or default start message, prepared by the response registry
+        method, kwargs = responses["start"]
+        getattr(bot, method)(message.chat.id, **kwargs)
         
     except Exception as e:
         logging.error(f"Start error: {e}")
 
-def send_default_start_message(message):
-    """Default start message if custom not set"""
-    welcome_text = f"""
-<b>🔥 PREMIUM CONTENT 🔥</b>
-
-• Price: <b>₹{AMOUNT}/- only</b>
-• Videos: <b>55k+ VIDEOS</b>
-• Access: <b>Lifetime</b>
-
-<b>Tap "Get Premium" to Buy</b>
-    """
-    
-    bot.send_message(
-        message.chat.id,
-        welcome_text,
-        reply_markup=premium_bot.main_menu_keyboard(),
-        parse_mode="HTML"
-    )
-
 # ========== GET PREMIUM ==========
 @bot.callback_query_handler(func=lambda call: call.data == "get_premium")
 def handle_get_premium(call):
+    """Get Premium click - acknowledged at once, the QR follows from the work queue"""
+    defer_callback(call, get_premium_work, call.from_user.id, call.message.chat.id)
+
+def get_premium_work(user_id, chat_id):
     """Get Premium click - DIRECT QR CODE GENERATE"""
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    
     # Check for spam (FIRST THING TO CHECK)
     spam_result = check_spam(user_id)
     if spam_result:
@@ -1978,7 +4479,6 @@ def handle_get_premium(call):
             bot.send_message(chat_id, spam_result, parse_mode="HTML")
         except:
             pass
-        bot.answer_callback_query(call.id)
         return
     
     # Reset spam counter for legit users
@@ -1986,106 +4486,105 @@ def handle_get_premium(call):
     
     # Log payment attempt
     if str(user_id) in users_data:
+        users_data[str(user_id)].setdefault('clicked_premium_at', time.time())
+        audience_index.record_premium_click(str(user_id))
         log_important_event("payment_attempt", users_data[str(user_id)])
     
-    # Generate QR code
-    qr_image = premium_bot.generate_qr_code(UPI_ID, AMOUNT, UPI_NAME)
-    
-    if qr_image:
-        caption = f"""
-<b>💰 PAY ₹{AMOUNT} FOR PREMIUM</b>
-
-<b>UPI Details:</b>
-└ ID: <code>{UPI_ID}</code>
-└ Name: {UPI_NAME}
-└ Amount: <b>₹{AMOUNT}</b>
-
-<b>Instructions:</b>
-1. Scan QR with any UPI app
-2. Pay ₹{AMOUNT}
-3. Click "Payment Done" below
-        """
-        
-        # Send QR code with Payment Done button
-        bot.send_photo(
+    if len(PRICE_TIERS) > 1:
+        bot.send_message(
             chat_id,
-            photo=qr_image,
-            caption=caption,
-            reply_markup=premium_bot.payment_keyboard()
+            responses["tier_prompt"],
+            reply_markup=responses["tier_markup"],
+            parse_mode="HTML"
         )
     else:
-        manual_text = f"""
-<b>💰 PAY ₹{AMOUNT}</b>
+        send_payment_qr(chat_id, user_id, next(iter(PRICE_TIERS)))
 
-<b>UPI ID:</b> <code>{UPI_ID}</code>
-<b>Amount:</b> ₹{AMOUNT}
+@bot.callback_query_handler(func=lambda call: call.data.startswith("tier_"))
+def handle_tier_choice(call):
+    """Plan picked from the tier keyboard - send its QR"""
+    defer_callback(call, tier_choice_work, call.from_user.id, call.message.chat.id, call.data[len("tier_"):])
 
-<b>Steps:</b>
-1. Send ₹{AMOUNT} to above UPI ID
-2. Click "Payment Done"
-        """
-        
+def tier_choice_work(user_id, chat_id, tier_key):
+    spam_result = check_spam(user_id)
+    if spam_result:
+        try:
+            bot.send_message(chat_id, spam_result, parse_mode="HTML")
+        except:
+            pass
+        return
+    
+    if tier_key in PRICE_TIERS:
+        send_payment_qr(chat_id, user_id, tier_key)
+
+def send_payment_qr(chat_id, user_id, tier_key):
+    """Payment QR for a tier, carrying the user's transaction reference"""
+    label, amount = PRICE_TIERS[tier_key]
+    ref = payment_ref(user_id, tier_key)
+    if str(user_id) in users_data:
+        users_data[str(user_id)].update(tier=tier_key, payment_ref=ref)
+        users_data[str(user_id)].setdefault("pending_refs", {})[ref] = tier_key
+    payment_verifier.expect(ref, user_id, tier_key)
+    
+    # Send QR code with Payment Done button (cached render / file_id)
+    head, tail = responses["qr_caption"][tier_key]
+    upi_url = premium_bot.upi_url(UPI_ID, amount, UPI_NAME, f"{UPI_NAME} {label}", ref)
+    if not payment_qr.send(chat_id, upi_url, head + ref + tail, responses["payment_markup"]):
+        head, tail = responses["manual_payment"][tier_key]
         bot.send_message(
             chat_id,
-            manual_text,
-            reply_markup=premium_bot.payment_keyboard()
+            head + ref + tail,
+            reply_markup=responses["payment_markup"]
         )
-    
-    bot.answer_callback_query(call.id)
 
 # ========== HOW TO GET ==========
 @bot.callback_query_handler(func=lambda call: call.data == "how_to_get")
 def handle_how_to_get(call):
     """How to get premium instructions"""
-    user_id = call.from_user.id
-    
+    defer_callback(call, how_to_get_work, call.from_user.id, call.message.chat.id, call.message.message_id)
+
+def how_to_get_work(user_id, chat_id, message_id):
     # Check for spam (FIRST THING TO CHECK)
     spam_result = check_spam(user_id)
     if spam_result:
         try:
-            bot.send_message(call.message.chat.id, spam_result, parse_mode="HTML")
+            bot.send_message(chat_id, spam_result, parse_mode="HTML")
         except:
             pass
-        bot.answer_callback_query(call.id)
         return
     
     # Reset spam counter for legit users
     reset_spam_counter(user_id)
     
-    instructions = f"""
-<b>❓ HOW TO GET PREMIUM:</b>
-
-1. Click "Get Premium" button
-2. Scan QR code and pay ₹{AMOUNT}
-3. Click "Payment Done" button
-4. Wait 10 seconds for verification
-
-<b>Support:</b> @{SUPPORT_USERNAME}
-    """
-    
-    try:
-        bot.edit_message_text(
-            instructions,
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            reply_markup=premium_bot.main_menu_keyboard()
-        )
-    except:
-        bot.send_message(
-            call.message.chat.id,
-            instructions,
-            reply_markup=premium_bot.main_menu_keyboard()
-        )
+    instructions = responses["how_to"]
     
-    bot.answer_callback_query(call.id)
+    if message_id is not None:
+        try:
+            bot.edit_message_text(
+                instructions,
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=responses["main_menu_markup"]
+            )
+            return
+        except:
+            pass
+    bot.send_message(
+        chat_id,
+        instructions,
+        reply_markup=responses["main_menu_markup"]
+    )
 
 # ========== PAYMENT DONE ==========
 @bot.callback_query_handler(func=lambda call: call.data == "payment_done")
 def handle_payment_done(call):
     """Payment Done clicked"""
-    user_id = call.from_user.id
-    chat_id = call.message.chat.id
-    
+    if payment_verifier.in_progress(call.from_user.id):
+        bot.answer_callback_query(call.id, "⏳ Already verifying your payment...")
+        return
+    defer_callback(call, payment_done_work, call.from_user.id, call.message.chat.id, call.message.message_id)
+
+def payment_done_work(user_id, chat_id, message_id):
     # Check for spam (FIRST THING TO CHECK)
     spam_result = check_spam(user_id)
     if spam_result:
@@ -2093,85 +4592,350 @@ def handle_payment_done(call):
             bot.send_message(chat_id, spam_result, parse_mode="HTML")
         except:
             pass
-        bot.answer_callback_query(call.id)
         return
     
     # Reset spam counter for legit users
     reset_spam_counter(user_id)
     
+    if str(user_id) in users_data:
+        users_data[str(user_id)].setdefault('payment_done_at', time.time())
+        audience_index.record_payment_done(str(user_id))
+    
     # Delete previous message
     try:
-        bot.delete_message(chat_id, call.message.message_id)
+        bot.delete_message(chat_id, message_id)
     except:
         pass
     
     # Send processing message
     processing_msg = bot.send_message(
         chat_id,
-        "🔍 <b>Verifying Payment...</b>\n\n⏳ Please wait 10 seconds...",
+        "🔍 <b>Verifying Payment...</b>\n\n⏳ Waiting for confirmation from your UPI app...",
         parse_mode="HTML"
     )
     
-    bot.answer_callback_query(call.id)
+    # Resolved by the payment webhook, or "not received" after PAYMENT_VERIFY_SECONDS
+    if not payment_verifier.start(chat_id, processing_msg.message_id, user_id):
+        # A second press raced past the in_progress check
+        try:
+            bot.delete_message(chat_id, processing_msg.message_id)
+        except:
+            pass
+
+# ========== CTA BUTTON CLICKS ==========
+@bot.callback_query_handler(func=lambda call: call.data.startswith('cta_'))
+def handle_cta_click(call):
+    """Count a broadcast CTA click, then open the flow the button points to"""
+    _, job_id, action = call.data.split('_', 2)
+    click_counter.record(job_id, call.from_user.id)
+    
+    target = CTA_ACTIONS.get(action, (None, None))[1]
+    if target == "get_premium":
+        handle_get_premium(call)  # Acknowledges and defers its own work; sends new messages
+    elif target == "how_to_get":
+        # message_id None: reply with a new message, the broadcast itself stays as sent
+        defer_callback(call, how_to_get_work, call.from_user.id, call.message.chat.id, None)
+    else:
+        bot.answer_callback_query(call.id)
+
+# ========== /SEGMENT COMMAND ==========
+@bot.message_handler(commands=['segment'])
+def handle_segment(message):
+    """Preview the size of a broadcast segment"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        bot.reply_to(message, SEGMENT_HELP, parse_mode="HTML")
+        return
+    
+    try:
+        started = time.perf_counter()
+        user_ids = build_audience(args[1])
+        build_ms = (time.perf_counter() - started) * 1000
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {html.escape(str(e))}\n{SEGMENT_HELP}", parse_mode="HTML")
+        return
     
-    # Start background processing
-    thread = threading.Thread(
-        target=process_payment,
-        args=(chat_id, processing_msg.message_id, user_id)
+    bot.reply_to(
+        message,
+        f"🎯 <b>Segment:</b> <code>{html.escape(args[1])}</code>\n\n"
+        f"👥 Users: <b>{len(user_ids)}</b> of {len(users_data)}\n"
+        f"⚡ Built in {build_ms:.1f} ms",
+        parse_mode="HTML"
     )
-    thread.start()
 
-def process_payment(chat_id, message_id, user_id):
-    """10 second payment processing"""
+# ========== /JOBS, /RETRYJOB & /CTR COMMANDS ==========
+@bot.message_handler(commands=['jobs'])
+def handle_jobs(message):
+    """List recent broadcast jobs with their delivery ledger counts"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    metas = BroadcastJob.recent()
+    if not metas:
+        bot.reply_to(message, "❌ No broadcast jobs yet")
+        return
+    
+    lines = ["<b>📋 RECENT BROADCAST JOBS</b>\n"]
+    for meta in metas:
+        counts = meta.get("counts", {})
+        created = datetime.fromtimestamp(meta["created_at"]).strftime("%m-%d %H:%M")
+        status = " ⏳ running" if meta["job_id"] in running_jobs else ""
+        lines.append(
+            f"🆔 <code>{meta['job_id']}</code> {payload_label(meta['payload'])} • {created}{status}\n"
+            f"   ✅ {counts.get('sent', 0)} ❌ {counts.get('failed', 0)} 🐢 {counts.get('throttled', 0)} "
+            f"💀 {counts.get('dead', 0)} ⏭️ {counts.get('skipped', 0)} ♻️ {counts.get('duplicate', 0)} "
+            f"⏸ {counts.get('pending', 0)} / {meta['total']}"
+        )
+    lines.append("\n🔁 <code>/retryjob &lt;id&gt; [failed|throttled|skipped|pending]</code>")
+    bot.reply_to(message, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=['retryjob'])
+def handle_retry_job(message):
+    """Re-run a job for only the recipients that did not get it"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    args = message.text.split()
+    if len(args) < 2:
+        bot.reply_to(message, "❌ Use: <code>/retryjob &lt;job_id&gt; [failed|throttled|skipped|pending]</code>\nSee /jobs", parse_mode="HTML")
+        return
+    
+    job_id = args[1]
+    job = BroadcastJob.load(job_id)
+    if job is None:
+        bot.reply_to(message, "❌ Job not found")
+        return
+    
+    # Default: everyone who failed or was throttled
+    wanted = args[2:] or ["failed", "throttled"]
+    if any(name not in DELIVERY_NAMES or name in ("sent", "dead", "duplicate") for name in wanted):
+        bot.reply_to(message, "❌ Retry outcomes must be: failed, throttled, skipped, pending")
+        return
+    positions = job.positions({DELIVERY_NAMES.index(name) for name in wanted})
+    if not positions:
+        bot.reply_to(message, f"✅ Nothing to retry for job {job_id}")
+        return
+    # Claimed here, not in the flow: two quick /retryjob must not both start it
+    if not reserve_job(job_id):
+        bot.reply_to(message, "⏳ This job is still running")
+        return
+    
     try:
-        # 10 second loading animation
-        for i in range(10):
-            dots = "⏳⌛🔍📊"
-            progress = "█" * (i+1) + "░" * (10-i-1)
-            
-            status = f"""
-<b>{dots[i%4]} Processing...</b>
+        progress_msg = bot.reply_to(
+            message,
+            f"🔁 <b>Retrying job {job_id}</b>\n\n⏳ Sending to {len(positions)} recipients ({', '.join(wanted)})...",
+            parse_mode="HTML"
+        )
+    except:
+        release_job(job_id)
+        raise
+    start_flow(process_broadcast, job, message.chat.id, progress_msg.message_id, positions)
 
-Progress: [{progress}] {(i+1)*10}%
-            """
-            
-            try:
-                bot.edit_message_text(
-                    status,
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    parse_mode="HTML"
-                )
-            except:
-                pass
-            
-            time.sleep(1)
-        
-        # After 10 seconds - Payment Not Received
-        failed_msg = f"""
-<b>❌ PAYMENT NOT RECEIVED</b>
+@bot.message_handler(commands=['ctr'])
+def handle_ctr(message):
+    """CTA click-through per broadcast job"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    args = message.text.split()
+    if len(args) > 1:
+        job = BroadcastJob.load(args[1])
+        metas = [job.meta] if job else []
+    else:
+        metas = [meta for meta in BroadcastJob.recent(30) if meta.get("cta")][:10]
+    if not metas:
+        bot.reply_to(message, "❌ No broadcast jobs with a CTA button")
+        return
+    
+    lines = ["<b>🖱 CTA CLICK-THROUGH</b>\n"]
+    for meta in metas:
+        clicks, unique = click_counter.totals(meta["job_id"])
+        sent = meta.get("counts", {}).get("sent", 0)
+        ctr = f"{unique / sent * 100:.1f}%" if sent else "-"
+        lines.append(
+            f"🆔 <code>{meta['job_id']}</code> {payload_label(meta['payload'])} • cta:{meta.get('cta') or 'none'}\n"
+            f"   ✅ {sent} sent  👆 {unique} users ({clicks} clicks)  📈 CTR {ctr}"
+        )
+    bot.reply_to(message, "\n".join(lines), parse_mode="HTML")
 
-<b>What to do:</b>
-1. Check payment in UPI app
-2. Ensure ₹{AMOUNT} sent to <code>{UPI_ID}</code>
-3. Try payment again
-4. Contact @{SUPPORT_USERNAME}
-        """
-        
-        # Log payment failure
-        if str(user_id) in users_data:
-            log_important_event("payment_failed", users_data[str(user_id)])
-        
-        bot.edit_message_text(
-            failed_msg,
-            chat_id=chat_id,
-            message_id=message_id,
-            reply_markup=premium_bot.after_payment_keyboard(),
+# ========== DIAGNOSTIC COMMANDS (/transport, /qrcache, /queue, /apitrace, /perf) ==========
+@bot.message_handler(commands=['transport'])
+def handle_transport(message):
+    """Show HTTP connection pool and Bot API latency counters"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    pool = ASYNC_POOL_SIZE if async_loop is not None else HTTP_POOL_SIZE
+    bot.reply_to(
+        message,
+        f"<b>🌐 HTTP TRANSPORT</b>\n\n⚙️ Pool size: {pool} | Workers: {BOT_WORKERS}\n\n{transport_stats.summary()}",
+        parse_mode="HTML"
+    )
+
+@bot.message_handler(commands=['qrcache'])
+def handle_qr_cache(message):
+    """Show payment QR cache hit rate and render latency"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    bot.reply_to(message, f"<b>🔳 PAYMENT QR CACHE</b>\n\n{payment_qr.summary()}", parse_mode="HTML")
+
+@bot.message_handler(commands=['queue'])
+def handle_queue(message):
+    """Show deferred work queue depth and wait times"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    bot.reply_to(message, f"<b>📥 DEFERRED WORK QUEUE</b>\n\n{deferred_work.summary()}", parse_mode="HTML")
+
+@bot.message_handler(commands=['apitrace'])
+def handle_api_trace(message):
+    """Bot API call mix, slow-call log, or the raw trace as CSV"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    args = message.text.split()
+    mode = args[1].lower() if len(args) > 1 else ""
+    if mode == "slow":
+        bot.reply_to(message, f"<b>🐢 SLOW BOT API CALLS</b> (≥ {API_SLOW_SECONDS}s)\n\n{api_tracer.slow_log()}", parse_mode="HTML")
+    elif mode == "export":
+        trace_file = api_tracer.export_csv()
+        trace_file.name = f"api_trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        bot.send_document(message.chat.id, trace_file, caption="📄 Bot API trace")
+    else:
+        bot.reply_to(
+            message,
+            f"<b>🛰 BOT API TRACE</b>\n\n{api_tracer.summary()}\n\n"
+            f"<code>/apitrace slow</code> - slow-call log\n<code>/apitrace export</code> - CSV file",
             parse_mode="HTML"
         )
+
+@bot.message_handler(commands=['perf'])
+def handle_perf(message):
+    """Per-handler latency percentiles over the last 1 and 15 minutes"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    def fmt(seconds):
+        return f"{seconds * 1000:.0f}ms" if seconds < 10 else f"{seconds:.0f}s"
+    
+    lines = ["<b>⏱ HANDLER LATENCY</b> (p50 / p95 / p99, calls)"]
+    for title, window in (("Last 1 min", 60), ("Last 15 min", PERF_WINDOW_SECONDS)):
+        lines.append(f"\n<b>{title}:</b>")
+        rows = perf_stats.report(window)
+        if not rows:
+            lines.append("• no calls")
+        for name, calls, p50, p95, p99 in rows[:20]:
+            lines.append(f"• <code>{name}</code>: {fmt(p50)} / {fmt(p95)} / {fmt(p99)} ({calls})")
+    lines.append(f"\n<b>GC pauses</b> (since start{', heap frozen' if gc.get_freeze_count() else ''}):")
+    for gen, collections, total, worst in gc_pauses.summary():
+        lines.append(f"• gen{gen}: {collections} runs, {total * 1000:.0f}ms total, worst {worst * 1000:.1f}ms")
+    lines.append("\n<i>Percentiles are bucket upper bounds (~26% resolution)</i>")
+    bot.reply_to(message, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=['profile'])
+def handle_profile(message):
+    """Sample every thread for N seconds, send collapsed stacks + top functions"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    args = message.text.split()
+    try:
+        seconds = min(PROFILE_MAX_SECONDS, max(1, int(args[1]))) if len(args) > 1 else 10
+    except ValueError:
+        bot.reply_to(message, "❌ Usage: <code>/profile [seconds]</code>", parse_mode="HTML")
+        return
+    if profiler.lock.locked():
+        bot.reply_to(message, "⏳ A profile is already running")
+        return
+    bot.reply_to(message, f"🔬 Profiling all threads for {seconds}s (every {PROFILE_INTERVAL_MS:g}ms)...")
+    
+    def run():
+        result = profiler.run(seconds)
+        if result is None:
+            bot.send_message(message.chat.id, "⏳ A profile is already running")
+            return
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        stack_file = BytesIO(SamplingProfiler.collapsed(result).encode())
+        stack_file.name = f"profile_{stamp}.collapsed.txt"
         
-    except Exception as e:
-        logging.error(f"Payment processing error: {e}")
+        rows, idle = SamplingProfiler.top_functions(result)
+        overhead = result["walking"] / result["elapsed"] * 100 if result["elapsed"] else 0
+        lines = [
+            f"<b>🔬 PROFILE</b> ({result['elapsed']:.1f}s, {result['samples']} samples, sampler {overhead:.1f}% of one core)",
+            f"Idle (waiting) thread samples: {idle}",
+            "",
+            "<b>Top functions</b> (self / total samples):",
+        ]
+        if not rows:
+            lines.append("• nothing busy")
+        for label, own, total in rows:
+            lines.append(f"• <code>{html.escape(label)}</code>: {own} / {total}")
+        lines.append("\n<i>Time blocked in C calls (sleep, socket reads) is charged to the calling Python frame</i>")
+        bot.send_document(message.chat.id, stack_file, caption="🔥 Collapsed stacks (flamegraph.pl / speedscope)")
+        bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+    
+    threading.Thread(target=run, name="profiler", daemon=True).start()
+
+@bot.message_handler(commands=['mem'])
+def handle_mem(message):
+    """Deep size per store, threads and tracemalloc growth since the baseline"""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    
+    args = message.text.split()
+    mode = args[1].lower() if len(args) > 1 else ""
+    if mode in ("trace", "reset"):
+        start_mem_trace()
+        bot.reply_to(message, "✅ tracemalloc on, baseline taken - /mem shows growth from now")
+        return
+    if mode == "stop":
+        stop_mem_trace()
+        bot.reply_to(message, "✅ tracemalloc off")
+        return
+    
+    def run():
+        try:
+            report()
+        except Exception as e:
+            logging.error(f"/mem error: {e}")
+            try:
+                bot.send_message(message.chat.id, f"❌ Memory report failed: {html.escape(str(e))}", parse_mode="HTML")
+            except Exception as e:
+                logging.error(f"/mem reply error: {e}")
+    
+    def report():
+        started = time.perf_counter()
+        sizes = sorted(((name, deep_size(store)) for name, store in memory_stores()), key=lambda item: -item[1])
+        threads = {}
+        for thread in threading.enumerate():
+            group = re.sub(r'[-_ ]?\d+$', '', re.sub(r' \(.*\)$', '', thread.name)) or thread.name
+            threads[group] = threads.get(group, 0) + 1
+        
+        lines = [f"<b>🧠 MEMORY</b> (RSS {human_bytes(process_rss())})", "", "<b>Stores</b> (estimated deep size):"]
+        lines += [f"• <code>{name}</code>: {human_bytes(size)}" for name, size in sizes]
+        lines.append(f"\n<b>Threads:</b> {threading.active_count()}")
+        lines += [f"• {html.escape(group)}: {count}" for group, count in sorted(threads.items(), key=lambda item: -item[1])]
+        
+        diff = mem_trace_diff()
+        if diff is None:
+            lines.append("\n<i>tracemalloc off - /mem trace starts it (MEM_TRACE=1 at startup)</i>")
+        else:
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"\n<b>Growth since baseline</b> (traced {human_bytes(current)}, peak {human_bytes(peak)}):")
+            for stat in diff:
+                frame = stat.traceback[0]
+                lines.append(
+                    f"• <code>{html.escape(os.path.basename(frame.filename))}:{frame.lineno}</code> "
+                    f"{'+' if stat.size_diff >= 0 else ''}{human_bytes(stat.size_diff)} ({stat.count_diff:+d} blocks)"
+                )
+        lines.append(f"\n<i>Measured in {time.perf_counter() - started:.2f}s · /mem trace retakes the baseline, /mem stop ends tracing</i>")
+        bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+    
+    threading.Thread(target=run, name="mem-report", daemon=True).start()
 
 # ========== OTHER ADMIN COMMANDS ==========
 @bot.message_handler(commands=['stats'])
@@ -2202,7 +4966,7 @@ def handle_stats(message):
 
 💰 <b>Payment Info:</b>
 • UPI ID: <code>{UPI_ID}</code>
-• Amount: ₹{AMOUNT}
+• Amount: {price_summary()} ({len(PRICE_TIERS)} tier(s))
 • Name: {UPI_NAME}
 
 📁 <b>Storage:</b>
@@ -2247,7 +5011,7 @@ def handle_backup(message):
                 caption=f"📦 Backup: {len(users_data)} users, {len(spam_data)} spam records\n⏰ {timestamp}"
             )
         
-        print(f"✅ Backup created: {backup_file}")
+        admin_log.info(f"✅ Backup created: {backup_file}", extra={"event": "backup", "file": backup_file})
         
     except Exception as e:
         bot.reply_to(message, f"❌ Backup failed: {str(e)}")
@@ -2299,6 +5063,7 @@ def handle_clear_start_message(message):
     global start_message_data
     start_message_data = {}
     save_start_message()
+    responses.rebuild()
     
     bot.reply_to(message, "✅ Custom start message cleared")
 
@@ -2309,15 +5074,9 @@ def handle_cancel(message):
         return
     
     user_id = message.from_user.id
-    cancelled = False
-    
-    for qid, queue in list(broadcast_queue.items()):
-        if queue.get("user_id") == user_id:
-            del broadcast_queue[qid]
-            cancelled = True
+    cancelled = album_sessions.remove_user(user_id)
     
     if cancelled:
-        save_broadcast_queue()
         bot.reply_to(message, "✅ Album broadcast cancelled!")
     else:
         bot.reply_to(message, "❌ No active album broadcast found")
@@ -2331,8 +5090,311 @@ def handle_all_messages(message):
         pass
     # No response for random messages
 
+# ========== HANDLER INSTRUMENTATION ==========
+def instrument(handler_name, function):
+    """Time a handler into handler_latency and perf_stats, counting exceptions"""
+    def timed(update):
+        started = time.perf_counter()
+        try:
+            return function(update)
+        except Exception:
+            handler_errors.inc(handler_name)
+            raise
+        finally:
+            observe_handler(handler_name, time.perf_counter() - started)
+    timed.__name__ = function.__name__
+    return timed
+
+def instrument_handlers():
+    for handler in bot.message_handlers + bot.callback_query_handlers:
+        handler['function'] = instrument(handler['function'].__name__, handler['function'])
+
+instrument_handlers()
+
+def collect_runtime_metrics():
+    samples = [
+        ("bot_threads", "Live threads", [([], threading.active_count())]),
+        ("bot_users", "Entries in users_data", [([], len(users_data))]),
+        ("bot_spam_records", "Entries in spam_data", [([], len(spam_data))]),
+        ("bot_queue_depth", "Items waiting per internal queue", [
+            ([("queue", "deferred_work")], deferred_work.queue.qsize()),
+            ([("queue", "log_pipeline")], len(log_pipeline.events)),
+            ([("queue", "media_groups")], len(media_groups.groups)),
+            ([("queue", "payment_waiters")], len(payment_verifier.waiting)),
+            ([("queue", "album_sessions")], len(album_sessions.store)),
+        ]),
+        ("bot_broadcasts_running", "Broadcast jobs in progress", [([], len(running_jobs))]),
+        ("bot_broadcast_send_rate", "Current AIMD send rate summed over running broadcasts (msg/s)",
+         [([], round(sum(controller.rate for controller in list(active_rate_controllers)), 3))]),
+        ("bot_last_save_bytes", "Bytes on disk after the last save_all_data", [([], last_save_bytes)]),
+    ]
+    lines = []
+    for name, help_text, values in samples:
+        lines += gauge_lines(name, help_text, values)
+    return lines
+
+metrics_collectors.append(collect_runtime_metrics)
+
+# ========== ASYNC RUNTIME ==========
+BOT_RUNTIME = os.environ.get("BOT_RUNTIME", "threads")  # "threads" or "async"
+ASYNC_HANDLER_WORKERS = int(os.environ.get("ASYNC_HANDLER_WORKERS", "16"))
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", "100"))
+
+class BridgedResponse:
+    """The parts of requests.Response that telebot.apihelper reads"""
+    def __init__(self, status_code, reason, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = content
+        self.text = content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+def create_async_session(ssl_context):
+    """aiohttp session whose trace hooks feed transport_stats"""
+    import aiohttp
+    
+    async def on_request_start(session, ctx, params):
+        ctx.started = time.perf_counter()
+
+    async def on_request_end(session, ctx, params):
+        response_bytes.set(params.response.content_length or 0)
+        transport_stats.record_request(api_method_from_url(params.url), time.perf_counter() - ctx.started, params.response.status)
+
+    async def on_request_exception(session, ctx, params):
+        transport_stats.record_request(api_method_from_url(params.url), time.perf_counter() - ctx.started, 0)
+
+    async def on_connection_create_end(session, ctx, params):
+        transport_stats.record_connection()
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    trace.on_request_exception.append(on_request_exception)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    
+    connector = aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, ssl=ssl_context, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+async def send_bridged_request(method, url, params, files, timeout):
+    from telebot import asyncio_helper
+    import aiohttp
+    
+    session = await asyncio_helper.session_manager.get_session()
+    data = asyncio_helper._prepare_data(params, files)
+    connect_timeout, read_timeout = timeout
+    client_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    async with session.request(method, url, data=data, timeout=client_timeout) as resp:
+        body = await resp.read()
+        return BridgedResponse(resp.status, resp.reason, body)
+
+def bridge_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """apihelper.CUSTOM_REQUEST_SENDER: sync bot calls share the async aiohttp pool"""
+    if threading.current_thread() is async_loop_thread:
+        raise RuntimeError("Sync bot call on the event loop thread - use a flow instead")
+    future = asyncio.run_coroutine_threadsafe(
+        send_bridged_request(method, url, params, files, timeout or (15, 30)),
+        async_loop
+    )
+    response = future.result()
+    response_bytes.set(len(response.content))
+    return response
+
+async def run_flow_async(flow):
+    """Drive a flow as a coroutine with the async bot"""
+    from telebot import asyncio_helper
+    
+    result, error = None, None
+    try:
+        while True:
+            try:
+                step = flow.throw(error) if error else flow.send(result)
+            except StopIteration as stop:
+                return stop.value
+            
+            kind, target, args, kwargs = step
+            result, error = None, None
+            if kind == "sleep":
+                await asyncio.sleep(target)
+                continue
+            try:
+                if kind == "blocking":
+                    result = await asyncio.get_running_loop().run_in_executor(None, lambda: target(*args, **kwargs))
+                else:
+                    result = await getattr(async_bot, target)(*args, **kwargs)
+            except asyncio_helper.ApiTelegramException as e:
+                # Flows catch the sync exception type
+                error = telebot.apihelper.ApiTelegramException(e.function_name, e.result, e.result_json)
+            except Exception as e:
+                error = e
+    except Exception as e:
+        logging.error(f"Flow error: {e}")
+
+def to_async_handler(func):
+    """Run an existing sync handler on the bounded handler pool"""
+    async def handler(update):
+        await asyncio.get_running_loop().run_in_executor(None, func, update)
+    handler.__name__ = func.__name__
+    return handler
+
+async def async_main():
+    global async_loop, async_loop_thread, async_bot
+    from telebot.async_telebot import AsyncTeleBot
+    from telebot import asyncio_helper
+    
+    # One aiohttp session / connection pool for every request the process makes
+    asyncio_helper.REQUEST_LIMIT = ASYNC_POOL_SIZE
+    asyncio_helper._process_request = traced_async_request(asyncio_helper._process_request)
+    asyncio_helper.session_manager.session = create_async_session(asyncio_helper.session_manager.ssl_context)
+    async_loop = asyncio.get_running_loop()
+    async_loop_thread = threading.current_thread()
+    async_loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=ASYNC_HANDLER_WORKERS, thread_name_prefix="handler")
+    )
+    async_bot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+    
+    # Same handlers, same filters, same order as the threaded bot
+    for handler in bot.message_handlers:
+        async_bot.add_message_handler(dict(handler, function=to_async_handler(handler['function'])))
+    for handler in bot.callback_query_handlers:
+        async_bot.add_callback_query_handler(dict(handler, function=to_async_handler(handler['function'])))
+    
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = bridge_request_sender
+    try:
+        await async_bot.infinity_polling()
+    finally:
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = None
+        await async_bot.close_session()
+
+# ========== BENCHMARKS ==========
+BENCH_USER_ID = 999000001
+
+def stub_bot_api():
+    """Answer every Bot API call locally (telebot still builds and serializes each request)"""
+    canned = json.dumps({"ok": True, "result": {
+        "message_id": 1, "date": 0, "chat": {"id": BENCH_USER_ID, "type": "private"}, "text": "ok"
+    }}).encode()
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = lambda *args, **kwargs: BridgedResponse(200, "OK", canned)
+
+def bench_message(user_id, text="/start"):
+    return types.Message.de_json({
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    })
+
+def bench_percentiles(samples, quantiles=(0.5, 0.95, 0.99)):
+    samples.sort()
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))] * 1e6
+    return " | ".join(f"p{q * 100:g} {pick(q):.0f}us" for q in quantiles)
+
+def benchmark_start(iterations=2000):
+    """python bot.py --bench-start [N]: /start handler latency with the network stubbed out"""
+    stub_bot_api()
+    message = bench_message(BENCH_USER_ID)
+    
+    try:
+        handle_start(message)  # warm-up (first visit logs a new user)
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            handle_start(message)
+            samples.append(time.perf_counter() - started)
+        print(f"/start handler ({iterations}x): {bench_percentiles(samples)}")
+        
+        built, cached = [], []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            premium_bot.main_menu_keyboard().to_json()
+            built.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            responses["main_menu_markup"]
+            cached.append(time.perf_counter() - started)
+        print(f"main menu markup, built per call: {bench_percentiles(built)}")
+        print(f"main menu markup, precompiled:    {bench_percentiles(cached)}")
+        
+        started = time.perf_counter()
+        responses.rebuild()
+        print(f"registry rebuild: {(time.perf_counter() - started) * 1e3:.2f}ms")
+    finally:
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = None
+        users_data.pop(str(BENCH_USER_ID), None)
+
+def benchmark_gc(users=500000, iterations=20000):
+    """python bot.py --bench-gc [USERS]: /start tail latency and GC pauses with a
+    large synthetic users_data, first with default GC, then after tune_gc(freeze=True).
+    Every 4th /start comes from a new user so long-lived objects keep accumulating.
+    Each phase ends with a timed gc.collect(): the pause an automatic gen2 run costs."""
+    stub_bot_api()
+    started = time.perf_counter()
+    joined = time.time()
+    for n in range(users):
+        user_id = str(100000000 + n)
+        users_data[user_id] = {"id": int(user_id), "username": f"user{n}", "first_name": "User", "last_name": "",
+                               "start_time": "2026-01-01 00:00:00", "joined_at": joined}
+        spam_data[user_id] = {"requests": [], "warnings": 0, "blocked_until": 0, "block_level": 0,
+                              "ban_reason": "", "banned_by": 0}
+    print(f"loaded {users} synthetic users in {time.perf_counter() - started:.1f}s, gc thresholds {gc.get_threshold()}")
+    regulars = [bench_message(100000000 + n) for n in range(0, users, max(1, users // 1000))]
+    next_new = [200000000]
+    
+    def phase(label):
+        pauses = []
+        def timer(stage, info, mark=[0.0]):
+            if stage == "start":
+                mark[0] = time.perf_counter()
+            else:
+                pauses.append((info["generation"], time.perf_counter() - mark[0]))
+        gc.callbacks.append(timer)
+        samples = []
+        try:
+            for i in range(iterations):
+                if i % 4 == 0:
+                    next_new[0] += 1
+                    message = bench_message(next_new[0])
+                else:
+                    message = regulars[i % len(regulars)]
+                tick = time.perf_counter()
+                handle_start(message)
+                samples.append(time.perf_counter() - tick)
+        finally:
+            gc.callbacks.remove(timer)
+        worst = max(samples)
+        print(f"{label}: {bench_percentiles(samples, (0.5, 0.99, 0.999))} | max {worst * 1e3:.1f}ms")
+        for gen in range(3):
+            times = [pause for g, pause in pauses if g == gen]
+            if times:
+                print(f"    gen{gen}: {len(times)} collections, worst {max(times) * 1e3:.2f}ms, total {sum(times) * 1e3:.1f}ms")
+        # What the next automatic full collection would cost at this heap size
+        tick = time.perf_counter()
+        gc.collect()
+        print(f"    full collection (gen2) pause: {(time.perf_counter() - tick) * 1e3:.1f}ms")
+    
+    try:
+        phase("default GC     ")
+        frozen = tune_gc(freeze=True)
+        print(f"froze {frozen} objects, thresholds {gc.get_threshold()}")
+        phase("frozen + tuned ")
+    finally:
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = None
+        gc.unfreeze()
+
 # ========== START BOT ==========
 if __name__ == "__main__":
+    if "--bench-start" in sys.argv:
+        args = sys.argv[sys.argv.index("--bench-start") + 1:]
+        benchmark_start(int(args[0]) if args and args[0].isdigit() else 2000)
+        sys.exit(0)
+    if "--gateway-pay" in sys.argv:
+        args = sys.argv[sys.argv.index("--gateway-pay") + 1:]
+        print(gateway_notify(args[0], float(args[1]), args[2] if len(args) > 2 else ""))
+        sys.exit(0)
+    if "--bench-gc" in sys.argv:
+        args = sys.argv[sys.argv.index("--bench-gc") + 1:]
+        benchmark_gc(int(args[0]) if args and args[0].isdigit() else 500000)
+        sys.exit(0)
+    
     print("=" * 60)
     print("🤖 PREMIUM TELEGRAM BOT - RAILWAY DEPLOYMENT")
     print("=" * 60)
@@ -2347,13 +5409,30 @@ if __name__ == "__main__":
     print(f"✅ Users Loaded: {len(users_data)}")
     print(f"✅ Data Directory: {DATA_DIR}")
     print(f"✅ UPI ID: {UPI_ID}")
-    print(f"✅ Amount: ₹{AMOUNT}")
+    print(f"✅ Amount: {price_summary()} ({', '.join(PRICE_TIERS)})")
     print(f"✅ Spam Protection: Active (Max: {MAX_SPAM_COUNT} in {SPAM_TIME_WINDOW}s)")
+    if start_metrics_server():
+        print(f"✅ Metrics: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if start_payment_webhook():
+        print(f"✅ Payment Webhook: http://{PAYMENT_WEBHOOK_HOST}:{PAYMENT_WEBHOOK_PORT}/payment")
+    else:
+        print("⚠️  Payment Webhook: disabled (set PAYMENT_WEBHOOK_PORT and PAYMENT_WEBHOOK_SECRET)")
     print("=" * 60)
     print("📋 Available Admin Commands:")
-    print("• /broadcast - Send single media/text to all users")
-    print("• /mbroadcast - Send album/multiple media (auto-detect)")
-    print("• /albumcast <count> - Manual album broadcast")
+    print("• /broadcast [segment] - Send single media/text to all users or a segment")
+    print("• /mbroadcast [segment] - Send album/multiple media (auto-detect)")
+    print("• /albumcast <count> [segment] - Manual album broadcast")
+    print("• /segment <spec> - Preview a broadcast audience segment")
+    print("• /jobs - Recent broadcast jobs and delivery ledgers")
+    print("• /retryjob <id> - Re-send a job to failed/throttled users only")
+    print("• /ctr [id] - CTA button click-through per broadcast job")
+    print("• /transport - HTTP pool and Bot API latency counters")
+    print("• /qrcache - Payment QR cache hit rate and render latency")
+    print("• /queue - Deferred callback work queue depth and wait times")
+    print("• /apitrace [slow|export] - Bot API call mix, slow calls, CSV trace")
+    print("• /perf - Handler latency p50/p95/p99 over 1 and 15 minutes, GC pauses")
+    print("• /profile [seconds] - Sample all threads, send collapsed stacks + top functions")
+    print("• /mem [trace|stop] - Store sizes, threads, tracemalloc growth since the baseline")
     print("• /cancel - Cancel ongoing album broadcast")
     print("• /impdata - Import JSON data (reply to file)")
     print("• /exportdata - Export all data as JSON file")
@@ -2366,11 +5445,20 @@ if __name__ == "__main__":
     print("• /clearstartmsg - Clear custom start message")
     print("• /savedata - Force save all data")
     print("=" * 60)
+    frozen = tune_gc()
+    if GC_FREEZE:
+        print(f"✅ GC: {frozen} startup objects frozen, thresholds {gc.get_threshold()}")
+    if MEM_TRACE and start_mem_trace() is not None:
+        print(f"✅ tracemalloc: baseline taken ({MEM_TRACE_FRAMES} frame(s))")
     print("🚀 Bot is starting...")
     print("=" * 60)
     
     try:
-        bot.infinity_polling()
+        if BOT_RUNTIME == "async":
+            print(f"⚡ Runtime: asyncio ({ASYNC_HANDLER_WORKERS} handler workers, pool {ASYNC_POOL_SIZE})")
+            asyncio.run(async_main())
+        else:
+            bot.infinity_polling()
     except Exception as e:
         print(f"❌ Bot Error: {e}")
         print("🔄 Attempting to restart in 10 seconds...")
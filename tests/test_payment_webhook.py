@@ -0,0 +1,139 @@
+"""Payment webhook end to end: bot.py's webhook on a free port, notified by
+the local stand-in gateway (gateway_notify)."""
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import pytest
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def bot_module():
+    os.environ.update({
+        "DATA_DIR": tempfile.mkdtemp(),
+        "BOT_TOKEN": "123:test",
+        "PRICE_TIERS": "basic:Basic:99,pro:Pro:199",
+        "PAYMENT_WEBHOOK_PORT": str(free_port()),
+        "PAYMENT_WEBHOOK_SECRET": "s3cret",
+        "MEM_TRACE": "0",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import requests
+    real_get = requests.get
+    def offline(*args, **kwargs):
+        raise requests.ConnectionError("offline")  # startup token check
+    requests.get = offline
+    try:
+        import bot
+    finally:
+        requests.get = real_get
+    sent = []
+    bot.bot.send_message = lambda chat_id, text, **kwargs: sent.append((chat_id, text))
+    bot.bot.edit_message_text = lambda text, **kwargs: sent.append((kwargs.get("chat_id"), text))
+    bot.start_payment_webhook()
+    bot.sent = sent
+    return bot
+
+
+def register(bot, user_id, *tiers):
+    bot.users_data.setdefault(str(user_id), {"id": user_id, "username": "u", "first_name": "U"})
+    refs = {}
+    for tier in tiers:
+        ref = bot.payment_ref(user_id, tier)
+        bot.users_data[str(user_id)].update(tier=tier, payment_ref=ref)
+        bot.users_data[str(user_id)].setdefault("pending_refs", {})[ref] = tier
+        bot.payment_verifier.expect(ref, user_id, tier)
+        refs[tier] = ref
+    return refs
+
+
+def wait_for(sent, chat_id):
+    for _ in range(50):
+        if any(chat == chat_id for chat, _ in sent):
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_refs_are_not_derived_from_user_id(bot_module):
+    ref = bot_module.payment_ref(21, "pro")
+    assert "21" not in ref[3:]
+    assert ref != bot_module.payment_ref(22, "pro")
+
+
+def test_unsigned_or_forged_notification_is_rejected(bot_module):
+    refs = register(bot_module, 21, "pro")
+    url = f"http://127.0.0.1:{bot_module.PAYMENT_WEBHOOK_PORT}/payment"
+    response = bot_module.requests.post(url, json={"ref": refs["pro"], "amount": 199}, timeout=5)
+    assert response.status_code == 401
+    response = bot_module.requests.post(url, json={"ref": refs["pro"], "amount": 199}, timeout=5,
+                                        headers={"X-Webhook-Signature": "sha256=" + "0" * 64})
+    assert response.status_code == 401
+    assert refs["pro"] in bot_module.payment_verifier.refs
+
+
+def test_amount_is_required_and_checked_against_the_refs_tier(bot_module):
+    refs = register(bot_module, 31, "basic", "pro")  # viewed pro last
+    assert bot_module.gateway_notify(refs["basic"], 199, "tx-a") == (409, {"status": "amount_mismatch"})
+    status = bot_module.requests.post(
+        f"http://127.0.0.1:{bot_module.PAYMENT_WEBHOOK_PORT}/payment",
+        data=b'{"ref": "%s"}' % refs["basic"].encode(),
+        headers={"X-Webhook-Signature": bot_module.webhook_signature(b'{"ref": "%s"}' % refs["basic"].encode())},
+        timeout=5,
+    ).status_code
+    assert status == 400
+    assert bot_module.gateway_notify(refs["basic"], 99, "tx-b") == (200, {"status": "confirmed"})
+    assert bot_module.users_data["31"]["tier"] == "basic"
+    assert wait_for(bot_module.sent, 31)
+
+
+def test_notifications_are_idempotent_and_repeat_purchases_get_new_refs(bot_module):
+    refs = register(bot_module, 41, "pro")
+    assert bot_module.gateway_notify(refs["pro"], 199) == (200, {"status": "confirmed"})
+    assert bot_module.gateway_notify(refs["pro"], 199) == (200, {"status": "duplicate"})
+    assert bot_module.gateway_notify(refs["pro"], 199, "other-txn") == (200, {"status": "duplicate"})
+    again = register(bot_module, 41, "pro")
+    assert again["pro"] != refs["pro"]
+    assert bot_module.gateway_notify(again["pro"], 199) == (200, {"status": "confirmed"})
+    assert bot_module.gateway_notify("PRONOTAREF", 199) == (404, {"status": "unknown_ref"})
+
+
+def test_refs_survive_a_rebuild(bot_module):
+    refs = register(bot_module, 51, "basic")
+    bot_module.payment_verifier.rebuild()
+    assert bot_module.payment_verifier.refs[refs["basic"]] == (51, "basic")
+    assert bot_module.gateway_notify(refs["basic"], 99) == (200, {"status": "confirmed"})
+    bot_module.payment_verifier.rebuild()
+    assert refs["basic"] not in bot_module.payment_verifier.refs
+
+
+def test_bad_content_length_is_rejected_without_blocking(bot_module):
+    for length in ("-1", None):
+        with socket.create_connection(("127.0.0.1", bot_module.PAYMENT_WEBHOOK_PORT), timeout=5) as sock:
+            headers = "POST /payment HTTP/1.1\r\nHost: x\r\n"
+            if length is not None:
+                headers += f"Content-Length: {length}\r\n"
+            sock.sendall((headers + "\r\n").encode())
+            assert sock.recv(64).startswith(b"HTTP/1.0 400")
+
+
+def test_nan_amount_does_not_confirm(bot_module):
+    refs = register(bot_module, 61, "basic")
+    assert bot_module.gateway_notify(refs["basic"], "NaN")[0] == 400
+    assert bot_module.payment_verifier.confirm(refs["basic"], "", "NaN") == "amount_mismatch"
+    assert refs["basic"] in bot_module.payment_verifier.refs
+
+
+def test_invalid_tier_amount_fails_at_parse_time(bot_module):
+    assert bot_module.parse_price_tiers("a:A:49")["a"] == ("A", "49")
+    for spec in ("a:A:free", "a:A:nan", "a:A:-5"):
+        with pytest.raises(ValueError):
+            bot_module.parse_price_tiers(spec)